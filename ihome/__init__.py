@@ -17,7 +17,7 @@ db = SQLAlchemy()
 csrf = CSRFProtect()
 
 # 创建redis对象
-redis_store = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT)
+redis_store = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB)
 
 # 设置日志记录选项
 # 设置日志记录等级
@@ -40,6 +40,9 @@ def create_app(config_name):
     app.config.from_object(config[config_name])
     # 关联数据库与应用
     db.init_app(app)
+    # redis_store在导入时创建，按app的配置重新设置连接池，测试时连接单独的redis库
+    redis_store.connection_pool = redis.ConnectionPool(host=app.config['REDIS_HOST'], port=app.config['REDIS_PORT'],
+                                                       db=app.config['REDIS_DB'])
     # 为app提供csrf保护
     csrf.init_app(app)
     # 为app中的url_map路由添加正则表达式匹配
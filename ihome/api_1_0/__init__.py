@@ -4,7 +4,7 @@ from flask import Blueprint
 
 api = Blueprint('api', __name__, url_prefix='/api/v1.0/')
 
-from . import register, users, house
+from . import register, users, house, orders, stats
 
 
 # @api.after_request
@@ -1,13 +1,38 @@
 # coding=utf-8
 
 from . import api
-from ihome import redis_store, constants, db
-from flask import current_app, jsonify, request, g
-from ihome.models import Area, Facility, House, HouseImage
+from ihome import constants, db
+from flask import current_app, jsonify, request, g, session, make_response
+from sqlalchemy import or_, false
+from ihome.models import Facility, House, HouseImage, Order, house_facility
 from ihome.response_code import RET
 import json
+import calendar
+from datetime import datetime, date
 from ihome.utils.commons import login_required
 from ihome.utils.image_storage import storage
+from ihome.utils import interval_index, house_cache, house_index, house_calendar, text_index, areas_cache, \
+    facility_catalog, counters, order_cache
+from ihome.utils.pagination import keyset_page
+from ihome.utils.cache import get_or_compute
+
+
+# 房屋列表的排序方式：(排序字段, 是否降序)
+HOUSE_LIST_SORTS = {
+    'new': (House.create_time, True),
+    'booking': (House.order_count, True),
+    'price-inc': (House.price, False),
+    'price-des': (House.price, True),
+}
+
+
+@api.before_app_first_request
+def build_house_text_index():
+    """应用处理第一个请求前，构建房屋标题和地址的全文索引"""
+    try:
+        text_index.house_text_index.build()
+    except Exception as e:
+        current_app.logger.error(e)
 
 
 @api.route('areas', methods=['GET'])
@@ -16,50 +41,61 @@ def get_areas():
     获取城区信息
     1. 无参数
     2. 不需要验证用户登录
-    3. 尝试从redis数据库中获取城区信息，
-    4. 校验数据，若有数据则直接返回给浏览器，若redis中无缓存数据，则查询数据库
-    5.
-    6. 询Area的信息，并返回给浏览器
+    3. 从进程内缓存获取城区信息的响应数据，只需从redis中读取版本号进行校验，
+       版本号变化或无缓存时从redis或数据库中重新加载
+    4. 浏览器携带的ETag(未压缩或压缩的数据)与当前版本一致时，返回304
+    5. 浏览器支持gzip时，返回压缩后的数据，ETag加上-gzip后缀
     :return:
     """
-    # 查询redis中的缓存信息
-    try:
-        areas = redis_store.get('areas')
-    except Exception as e:
-        current_app.logger.error(e)
-        areas = None
-    # 如果查询有数据，则直接返回结果，
-    if areas:
-        current_app.logger.info('get areas info from redis')
-        print areas
-        return '{"errno":0,"errmsg":"OK","data":%s}' % areas
-    # 如果查询无数据， 则进入mysql中查询
+    # 获取城区信息的响应缓存
     try:
-        areas = Area.query.all()
+        areas = areas_cache.get_areas_response()
     except Exception as e:
         current_app.logger.error(e)
         return jsonify(errno=RET.DBERR, errmsg='数据库查询异常')
-    # 校验areas 是否为空，如果为空
+    # 校验areas 是否为空
     if not areas:
         return jsonify(errno=RET.NODATA, errmsg='没有城区信息')
 
-    # 如果数据不为空，则遍历一下
-    arealist = []
-    for area in areas:
-        arealist.append(area.to_dict())
-    # 将数据转环卫json
-    area_json = json.dumps(arealist)
-    print area_json
+    # 压缩后的数据使用单独的ETag，避免缓存服务器把两种数据当作同一个版本
+    gzip_etag = areas['etag'] + '-gzip'
+    use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    etag = gzip_etag if use_gzip else areas['etag']
 
-    # 将数据保存到redis缓存中
+    # 浏览器的缓存仍然有效，两种数据的ETag都对应当前版本
+    if areas['etag'] in request.if_none_match or gzip_etag in request.if_none_match:
+        response = make_response('', 304)
+    elif use_gzip:
+        response = make_response(areas['gzip_body'])
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = make_response(areas['body'])
+
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(etag)
+    return response
+
+
+@api.route('facilities', methods=['GET'])
+def get_facilities():
+    """
+    获取设施信息
+    1. 无参数
+    2. 不需要验证用户登录
+    3. 从进程内的设施目录获取响应数据，只需从redis中读取版本号进行校验
+    :return:
+    """
     try:
-        redis_store.setex('areas', constants.AREA_INFO_REDIS_EXPIRES, area_json)
+        catalog = facility_catalog.get_catalog()
     except Exception as e:
         current_app.logger.error(e)
+        return jsonify(errno=RET.DBERR, errmsg='数据库查询异常')
+    if not catalog['facilities']:
+        return jsonify(errno=RET.NODATA, errmsg='没有设施信息')
 
-    # 将城区信息返回给浏览器
-    resp = '{"errno":0, "errmsg":"OK", "data":%s}' % area_json
-    return resp
+    return catalog['body'], 200, {'Content-Type': 'application/json'}
 
 
 @api.route('houses', methods=['POST'])
@@ -122,26 +158,37 @@ def set_house_info():
 
     # 4. 获取房屋配额设施
     facility = house_data.get('facility')
-    print facility
 
-    # 5. 验证房屋数据是否有效，去掉无效数据
+    # 5. 使用进程内的设施目录验证设施编号是否有效，去掉无效数据
+    facility_ids = []
     if facility:
         try:
-            facilities = Facility.query.filter(Facility.id.in_(facility)).all()
-            house.facilities = facilities
+            facility_ids = facility_catalog.validate_facility_ids(facility)
         except Exception as e:
             current_app.logger.error(e)
             return jsonify(errno=RET.DATAERR, errmsg='获取用户设施失败')
 
-    # 7. 向数据库中保存模型对象
+    # 7. 向数据库中保存模型对象，设施已校验，直接写入房屋设施表，不再查询设施对象
     try:
         db.session.add(house)
+        if facility_ids:
+            db.session.flush()
+            db.session.execute(house_facility.insert(),
+                               [{'house_id': house.id, 'facility_id': facility_id} for facility_id in facility_ids])
         db.session.commit()
     except Exception as e:
         current_app.logger.error(e)
         db.session.rollback()
         return jsonify(errno=RET.DBERR, errmsg='保存数据异常')
 
+    # 8. 房屋数据变化后，更新排序索引和全文索引，删除该城区的房屋列表缓存
+    try:
+        house_index.index_house(house, facility_ids)
+        text_index.notify_house_changed(house.id)
+        house_cache.invalidate_house_list(area_id)
+    except Exception as e:
+        current_app.logger.error(e)
+
     return jsonify(errno=RET.OK, errmsg='OK', data={'house_id': house.id})
 
 
@@ -191,7 +238,398 @@ def set_house_images(house_id):
         current_app.logger.error(e)
         db.session.rollback()
         return jsonify(errno=RET.DBERR, errmsg='更新图片信息到数据库错误')
+    # 房屋主图片可能发生变化，删除该城区的房屋列表缓存
+    try:
+        house_cache.invalidate_house_list(house.area_id)
+    except Exception as e:
+        current_app.logger.error(e)
+    # 房屋有了主图片后才能在首页展示，增量更新首页排行，并删除房屋详情缓存
+    # 数据库中的订单数不包含redis中缓冲的增量，加上增量后再更新排行
+    try:
+        order_count = (house.order_count or 0) + counters.get_buffered_order_count(house.id)
+        house_cache.update_home_page_house(house, order_count)
+        house_cache.invalidate_house_detail(house_id)
+    except Exception as e:
+        current_app.logger.error(e)
+    # 订单列表中包含房屋的主图片和标题，删除房东和该房屋房客的订单列表缓存
+    try:
+        custom_ids = [row.user_id for row in
+                      db.session.query(Order.user_id).filter(Order.house_id == house_id).distinct().all()]
+        order_cache.invalidate_user_orders(custom_ids=custom_ids, landlord_ids=[house.user_id])
+    except Exception as e:
+        current_app.logger.error(e)
     # 拼接完整的url返回给浏览器
     image_url = constants.QINIU_DOMIN_PREFIX + image_name
     return jsonify(errno=RET.OK, errmsg='OK', data={'url': image_url})
 
+
+def _query_house_index():
+    """
+    查询首页展示的房屋信息
+    1. 从redis的首页排行中获取订单数最多的房屋编号，排行不存在时从数据库构建一次
+    2. 批量获取房屋的基本信息缓存，缺少缓存的房屋统一查询数据库后补充缓存
+    3. 按排行顺序拼接房屋基本信息
+    :return: (响应数据, 错误响应)
+    """
+    # 1. 获取首页排行中的房屋编号
+    try:
+        house_ids = house_cache.get_home_page_house_ids()
+        if house_ids is None:
+            house_ids = [house.id for house in house_cache.rebuild_home_page_houses()]
+    except Exception as e:
+        current_app.logger.error(e)
+        house_ids = None
+
+    # redis不可用时，直接查询数据库
+    if house_ids is None:
+        try:
+            houses = House.query.filter(House.index_image_url != '')\
+                .order_by(House.order_count.desc()).limit(constants.HOME_PAGE_MAX_HOUSES).all()
+        except Exception as e:
+            current_app.logger.error(e)
+            return None, jsonify(errno=RET.DBERR, errmsg='查询房屋信息失败')
+        houses_json = json.dumps(House.batch_to_basic_dict(houses))
+        return '{"errno":0,"errmsg":"OK","data":%s}' % houses_json, None
+
+    # 2. 批量获取房屋基本信息的缓存
+    try:
+        house_data = house_cache.get_home_page_house_data(house_ids)
+    except Exception as e:
+        current_app.logger.error(e)
+        house_data = [None] * len(house_ids)
+
+    # 没有缓存的房屋统一查询一次数据库
+    missing_ids = [house_id for house_id, data in zip(house_ids, house_data) if data is None]
+    if missing_ids:
+        try:
+            houses = House.query.filter(House.id.in_(missing_ids)).all()
+        except Exception as e:
+            current_app.logger.error(e)
+            return None, jsonify(errno=RET.DBERR, errmsg='查询房屋信息失败')
+        missing_data = {}
+        for house, house_dict in zip(houses, House.batch_to_basic_dict(houses)):
+            missing_data[house.id] = json.dumps(house_dict)
+        try:
+            house_cache.set_home_page_house_data(missing_data)
+        except Exception as e:
+            current_app.logger.error(e)
+        house_data = [data if data is not None else missing_data.get(house_id)
+                      for house_id, data in zip(house_ids, house_data)]
+
+    # 3. 按排行顺序拼接返回数据
+    houses_json = '[%s]' % ','.join(data for data in house_data if data)
+    return '{"errno":0,"errmsg":"OK","data":%s}' % houses_json, None
+
+
+@api.route('houses/index', methods=['GET'])
+def get_house_index():
+    """
+    获取首页幻灯片展示的房屋信息
+    1. 无参数，不需要验证用户登录
+    2. 从两级缓存中获取首页的响应数据，没有缓存时只有一个进程查询排行和房屋信息
+    3. 返回按排行顺序排列的房屋基本信息
+    :return:
+    """
+    resp_json, error_resp, source = get_or_compute(house_cache.HOME_PAGE_CACHE_KEY, _query_house_index,
+                                                   constants.HOME_PAGE_DATA_REDIS_EXPIRES)
+    if error_resp is not None:
+        return error_resp
+    return resp_json, 200, {'Content-Type': 'application/json'}
+
+
+def _query_house_detail(house_id):
+    """
+    查询房屋详情
+    :return: (房屋详情json数据, 错误响应)
+    """
+    try:
+        house = House.query.get(house_id)
+    except Exception as e:
+        current_app.logger.error(e)
+        return None, jsonify(errno=RET.DBERR, errmsg='查询房屋信息失败')
+    if not house:
+        return None, jsonify(errno=RET.NODATA, errmsg='房屋不存在')
+
+    # 评论信息从redis的评论feed中读取
+    try:
+        comments = house_cache.get_house_comments(house_id)
+    except Exception as e:
+        current_app.logger.error(e)
+        comments = None
+
+    try:
+        return json.dumps(house.to_full_dict(comments)), None
+    except Exception as e:
+        current_app.logger.error(e)
+        return None, jsonify(errno=RET.DATAERR, errmsg='房屋数据错误')
+
+
+@api.route('houses/<int:house_id>', methods=['GET'])
+def get_house_detail(house_id):
+    """
+    获取房屋详情
+    1. 获取当前登录用户的user_id，未登录时为-1，前端据此判断是否展示预订按钮
+    2. 从两级缓存中获取房屋详情，没有缓存时只有一个进程查询数据库并写入缓存
+    3. 返回房屋详情，user_id因用户而异，不放入缓存
+    :param house_id: 房屋编号
+    :return:
+    """
+    # 1. 获取当前用户
+    user_id = session.get('user_id', -1)
+
+    # 2. 获取房屋详情
+    house_json, error_resp, source = get_or_compute(house_cache.house_detail_key(house_id),
+                                                    lambda: _query_house_detail(house_id),
+                                                    constants.HOUSE_DETAIL_REDIS_EXPIRE_SECOND)
+    if error_resp is not None:
+        return error_resp
+
+    # 3. 返回房屋详情
+    return '{"errno":0,"errmsg":"OK","data":{"user_id":%s,"house":%s}}' % (user_id, house_json), \
+        200, {'Content-Type': 'application/json'}
+
+
+@api.route('houses/<int:house_id>/calendar', methods=['GET'])
+def get_house_calendar(house_id):
+    """
+    获取房屋某个月的预订日历
+    1. 获取参数：月份month，格式为YYYY-MM，默认为当前月份
+    2. 从redis的预订日历位图中取出该月已被预订的日期
+    3. 返回该月的天数和已被预订的日期
+    预订日历本身是redis中的位图，只需一次GETRANGE，不再另外缓存响应
+    :param house_id: 房屋编号
+    :return:
+    """
+    # 1. 获取并校验月份参数
+    month = request.args.get('month')
+    try:
+        month_date = datetime.strptime(month, '%Y-%m').date() if month else date.today().replace(day=1)
+    except Exception as e:
+        current_app.logger.error(e)
+        return jsonify(errno=RET.PARAMERR, errmsg='月份参数错误')
+
+    # 2. 查询该月已被预订的日期
+    days = calendar.monthrange(month_date.year, month_date.month)[1]
+    try:
+        booked_days = house_calendar.get_booked_days(house_id, month_date, month_date.replace(day=days))
+    except Exception as e:
+        current_app.logger.error(e)
+        return jsonify(errno=RET.DBERR, errmsg='查询预订日历失败')
+
+    # 3. 返回结果
+    return jsonify(errno=RET.OK, errmsg='OK', data={
+        'month': month_date.strftime('%Y-%m'),
+        'days': days,
+        'booked_days': [booked_day.day for booked_day in booked_days]
+    })
+
+
+@api.route('houses', methods=['GET'])
+def get_house_list():
+    """
+    搜索房屋列表
+    1. 获取参数：城区编号aid，入住日期sd，离开日期ed，排序方式sk，页码p或游标cursor，
+       设施编号fac(多个设施以逗号分隔，房屋须具备全部设施)，关键词q
+    2. 校验日期参数，开始日期不能晚于结束日期
+    3. 通过订单区间索引查询该时间段内已被预订的房屋，从结果中排除，
+       有关键词时通过全文索引查询标题或地址包含关键词的房屋
+    4. 按排序方式查询房屋信息，传入cursor参数时使用游标分页，
+       否则按页码分页，优先从redis的排序索引中取出当前页的房屋编号
+    5. 返回房屋列表数据，没有关键词时使用两级缓存，没有缓存时只有一个进程查询
+    :return:
+    """
+    # 1. 获取参数
+    area_id = request.args.get('aid', '')
+    start_date_str = request.args.get('sd', '')
+    end_date_str = request.args.get('ed', '')
+    sort_key = request.args.get('sk', 'new')
+    page = request.args.get('p', '1')
+    cursor = request.args.get('cursor')
+    facility = request.args.get('fac', '')
+    keyword = request.args.get('q', '').strip()
+    if sort_key not in HOUSE_LIST_SORTS:
+        sort_key = 'new'
+
+    # 校验设施参数
+    try:
+        facility_ids = sorted(set(int(facility_id) for facility_id in facility.split(',') if facility_id))
+    except Exception as e:
+        current_app.logger.error(e)
+        return jsonify(errno=RET.PARAMERR, errmsg='设施参数错误')
+    facility = ','.join(str(facility_id) for facility_id in facility_ids)
+
+    # 校验城区参数，转换为整数后再用于缓存的键名，"01"与"1"使用同一个版本号
+    try:
+        area_id = int(area_id) if area_id else ''
+        if area_id != '' and area_id <= 0:
+            raise ValueError('invalid area id: %s' % area_id)
+    except Exception as e:
+        current_app.logger.error(e)
+        return jsonify(errno=RET.PARAMERR, errmsg='城区参数错误')
+
+    # 2. 校验日期参数
+    try:
+        start_date = datetime.strptime(start_date_str, '%Y-%m-%d') if start_date_str else None
+        end_date = datetime.strptime(end_date_str, '%Y-%m-%d') if end_date_str else None
+    except Exception as e:
+        current_app.logger.error(e)
+        return jsonify(errno=RET.PARAMERR, errmsg='日期参数错误')
+    if start_date and end_date and start_date > end_date:
+        return jsonify(errno=RET.PARAMERR, errmsg='开始日期不能晚于结束日期')
+
+    # 校验页码
+    try:
+        page = int(page)
+    except Exception as e:
+        current_app.logger.error(e)
+        page = 1
+    # 游标分页时，以游标作为缓存字段
+    cache_field = page if cursor is None else 'cursor_%s' % cursor
+
+    def query_house_list():
+        return _query_house_list(area_id, start_date, end_date, sort_key, page, cursor, facility_ids, keyword)
+
+    # 关键词查询的组合过多，不做缓存
+    # 缓存的键名中包含城区的版本号，使用查询前读取的版本号，查询期间缓存已失效时写入的是旧版本的键
+    cache_version = None
+    if not keyword:
+        try:
+            cache_version = house_cache.get_house_list_version(area_id)
+        except Exception as e:
+            current_app.logger.error(e)
+    if cache_version is None:
+        resp_json, error_resp = query_house_list()
+    else:
+        cache_key = house_cache.house_list_key(cache_version, area_id, start_date_str, end_date_str, sort_key,
+                                               cache_field, facility)
+        resp_json, error_resp, source = get_or_compute(cache_key, query_house_list,
+                                                       constants.HOUSE_LIST_REDIS_EXPIRES)
+    if error_resp is not None:
+        return error_resp
+    return resp_json, 200, {'Content-Type': 'application/json'}
+
+
+def _facility_filters(facility_ids):
+    """
+    按设施筛选房屋的查询条件
+    优先用redis中设施集合的交集得到房屋编号，索引不可用时退回到每个设施一个子查询
+    """
+    if not facility_ids:
+        return []
+    try:
+        house_ids = house_index.get_facility_house_ids(facility_ids)
+    except Exception as e:
+        current_app.logger.error(e)
+        house_ids = None
+    if house_ids is None:
+        return [House.facilities.any(Facility.id == facility_id) for facility_id in facility_ids]
+    if not house_ids:
+        return [false()]
+    return [House.id.in_(house_ids)]
+
+
+def _query_house_list(area_id, start_date, end_date, sort_key, page, cursor, facility_ids, keyword):
+    """
+    按条件查询房屋列表
+    :return: (响应数据, 不缓存的响应)，出错或页码超出总页数时返回的响应不缓存
+    """
+    # 1. 查询该时间段内有冲突订单的房屋
+    try:
+        conflict_house_ids = interval_index.get_conflict_house_ids(start_date, end_date, area_id)
+    except Exception as e:
+        current_app.logger.error(e)
+        # redis不可用时，退回到数据库查询冲突订单
+        conflict_house_ids = None
+
+    filters = []
+    if area_id:
+        filters.append(House.area_id == area_id)
+    if conflict_house_ids is None and (start_date or end_date):
+        conflict_query = db.session.query(Order.house_id)\
+            .filter(Order.status.in_(interval_index.ACTIVE_ORDER_STATUS))
+        if start_date:
+            conflict_query = conflict_query.filter(Order.end_date >= start_date)
+        if end_date:
+            conflict_query = conflict_query.filter(Order.begin_date <= end_date)
+        filters.append(House.id.notin_(conflict_query))
+    elif conflict_house_ids:
+        filters.append(House.id.notin_(conflict_house_ids))
+
+    # 查询标题或地址包含关键词的房屋
+    if keyword:
+        try:
+            filters.append(House.id.in_(list(text_index.search_houses(keyword))))
+        except Exception as e:
+            current_app.logger.error(e)
+            # 全文索引不可用时，退回到数据库模糊查询
+            like = u'%%%s%%' % keyword
+            filters.append(or_(House.title.like(like), House.address.like(like)))
+
+    # 2. 按排序方式查询，并分页
+    house_query = House.query.filter(*filters)
+    sort_column, descending = HOUSE_LIST_SORTS[sort_key]
+
+    if cursor is not None:
+        # 游标分页，查询代价与页数无关
+        house_query = house_query.filter(*_facility_filters(facility_ids))
+        try:
+            house_items, next_cursor = keyset_page(house_query, sort_column, House.id, descending,
+                                                   cursor, constants.HOUSE_LIST_PAGE_CAPACITY)
+        except ValueError as e:
+            current_app.logger.error(e)
+            return None, jsonify(errno=RET.PARAMERR, errmsg='分页参数错误')
+        except Exception as e:
+            current_app.logger.error(e)
+            return None, jsonify(errno=RET.DBERR, errmsg='查询房屋信息失败')
+        data = {'next_cursor': next_cursor or ''}
+    else:
+        # 优先使用redis中的排序索引取出当前页的房屋编号，索引不可用时返回None
+        index_result = None
+        if conflict_house_ids is not None and not keyword:
+            try:
+                index_result = house_index.search_house_ids(area_id, sort_key, page,
+                                                            constants.HOUSE_LIST_PAGE_CAPACITY,
+                                                            conflict_house_ids, facility_ids)
+            except Exception as e:
+                current_app.logger.error(e)
+
+        if index_result is not None:
+            house_ids, total = index_result
+            total_page = (total + constants.HOUSE_LIST_PAGE_CAPACITY - 1) // constants.HOUSE_LIST_PAGE_CAPACITY
+            # 按编号批量查询当前页的房屋，并按索引中的顺序排列
+            try:
+                houses = House.query.filter(House.id.in_(house_ids)).all() if house_ids else []
+            except Exception as e:
+                current_app.logger.error(e)
+                return None, jsonify(errno=RET.DBERR, errmsg='查询房屋信息失败')
+            house_map = dict((house.id, house) for house in houses)
+            house_items = [house_map[house_id] for house_id in house_ids if house_id in house_map]
+        else:
+            house_query = house_query.filter(*_facility_filters(facility_ids))
+            if descending:
+                house_query = house_query.order_by(sort_column.desc(), House.id.desc())
+            else:
+                house_query = house_query.order_by(sort_column.asc(), House.id.asc())
+            try:
+                house_page = house_query.paginate(page, constants.HOUSE_LIST_PAGE_CAPACITY, False)
+            except Exception as e:
+                current_app.logger.error(e)
+                return None, jsonify(errno=RET.DBERR, errmsg='查询房屋信息失败')
+            house_items = house_page.items
+            total_page = house_page.pages
+        data = {'total_page': total_page, 'current_page': page}
+
+    # 3. 构造返回数据
+    try:
+        data['houses'] = House.batch_to_basic_dict(house_items)
+    except Exception as e:
+        current_app.logger.error(e)
+        return None, jsonify(errno=RET.DBERR, errmsg='查询房屋信息失败')
+
+    resp_dict = dict(errno=RET.OK, errmsg='OK', data=data)
+    resp_json = json.dumps(resp_dict)
+
+    # 超出总页数的页码不缓存
+    if cursor is None and page > total_page:
+        return None, (resp_json, 200, {'Content-Type': 'application/json'})
+    return resp_json, None
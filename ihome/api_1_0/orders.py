@@ -0,0 +1,398 @@
+# coding=utf-8
+
+from . import api
+from ihome import db, constants
+from flask import current_app, jsonify, request, g
+from sqlalchemy.orm import contains_eager, joinedload
+from ihome.models import House, Order
+from ihome.response_code import RET
+from ihome.utils.commons import login_required
+from ihome.utils.cache import get_or_compute
+from ihome.utils import house_cache, house_index, house_calendar, interval_index, order_cache, counters
+from datetime import datetime
+import json
+
+
+@api.route('orders', methods=['POST'])
+@login_required
+def create_order():
+    """
+    创建订单
+    1. 获取参数：房屋编号house_id，入住日期start_date，离开日期end_date
+    2. 校验参数，计算入住天数
+    3. 通过redis中的预订日历快速判断日期是否已被预订
+    4. 对房屋记录加行锁，同一房屋的预订请求依次处理，不同房屋之间互不影响
+    5. 在行锁保护下用加锁读取查询是否有冲突的订单，防止并发请求重复预订
+    6. 根据房屋单价计算订单金额，保存订单，提交事务后释放行锁
+    7. 更新订单区间索引和预订日历，删除该城区的房屋列表缓存
+    :return:
+    """
+    # 1. 获取参数
+    order_data = request.get_json()
+    if not order_data:
+        return jsonify(errno=RET.PARAMERR, errmsg='参数错误')
+    house_id = order_data.get('house_id')
+    start_date_str = order_data.get('start_date')
+    end_date_str = order_data.get('end_date')
+    if not all([house_id, start_date_str, end_date_str]):
+        return jsonify(errno=RET.PARAMERR, errmsg='参数不完整')
+
+    # 2. 校验日期，计算入住天数，入住和离开当天都计算在内
+    try:
+        house_id = int(house_id)
+        start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
+        end_date = datetime.strptime(end_date_str, '%Y-%m-%d')
+    except Exception as e:
+        current_app.logger.error(e)
+        return jsonify(errno=RET.PARAMERR, errmsg='参数格式错误')
+    if start_date > end_date:
+        return jsonify(errno=RET.PARAMERR, errmsg='入住日期不能晚于离开日期')
+    days = (end_date - start_date).days + 1
+
+    # 3. 预订日历中已被预订的日期直接返回，不再访问数据库
+    try:
+        available = house_calendar.is_available(house_id, start_date, end_date)
+    except Exception as e:
+        current_app.logger.error(e)
+        available = True
+    if not available:
+        return jsonify(errno=RET.DATAERR, errmsg='房屋已被预订')
+
+    # 4. 查询房屋并加行锁
+    try:
+        house = House.query.filter_by(id=house_id).with_for_update().first()
+    except Exception as e:
+        current_app.logger.error(e)
+        db.session.rollback()
+        return jsonify(errno=RET.DBERR, errmsg='查询房屋信息失败')
+    if not house:
+        db.session.rollback()
+        return jsonify(errno=RET.NODATA, errmsg='房屋不存在')
+    if house.user_id == g.user_id:
+        db.session.rollback()
+        return jsonify(errno=RET.ROLEERR, errmsg='不能预订自己的房屋')
+    if days < house.min_days or (house.max_days and days > house.max_days):
+        db.session.rollback()
+        return jsonify(errno=RET.PARAMERR, errmsg='入住天数不符合要求')
+
+    # 5. 查询冲突的订单
+    # 使用加锁读取，读到其他请求在等待行锁期间提交的订单，
+    # 普通查询在可重复读隔离级别下使用事务中第一次读取时的快照，会漏掉这些订单
+    try:
+        conflict = db.session.query(Order.id).filter(Order.house_id == house_id,
+                                                     Order.status.in_(interval_index.ACTIVE_ORDER_STATUS),
+                                                     Order.begin_date <= end_date,
+                                                     Order.end_date >= start_date).with_for_update().first()
+    except Exception as e:
+        current_app.logger.error(e)
+        db.session.rollback()
+        return jsonify(errno=RET.DBERR, errmsg='查询订单信息失败')
+    if conflict is not None:
+        db.session.rollback()
+        return jsonify(errno=RET.DATAERR, errmsg='房屋已被预订')
+
+    # 6. 保存订单
+    order = Order()
+    order.user_id = g.user_id
+    order.house_id = house_id
+    order.begin_date = start_date
+    order.end_date = end_date
+    order.days = days
+    order.house_price = house.price
+    order.amount = days * house.price
+    try:
+        db.session.add(order)
+        db.session.commit()
+    except Exception as e:
+        current_app.logger.error(e)
+        db.session.rollback()
+        return jsonify(errno=RET.DBERR, errmsg='保存订单失败')
+
+    # 7. 更新redis中的索引和缓存
+    try:
+        interval_index.add_order_interval(order, house.area_id)
+        house_calendar.mark_order_days(order)
+        house_cache.invalidate_house_list(house.area_id)
+        order_cache.invalidate_user_orders(custom_ids=[g.user_id], landlord_ids=[house.user_id])
+    except Exception as e:
+        current_app.logger.error(e)
+
+    return jsonify(errno=RET.OK, errmsg='OK', data={'order_id': order.id})
+
+
+def _change_orders_status(landlord_id, order_ids, action, reason=None):
+    """
+    房东批量接单或拒单
+    先锁定请求的订单，逐个判断是否可以处理，再用一条UPDATE语句修改全部可处理的订单
+    :param landlord_id: 房东的用户编号
+    :param order_ids: 订单编号列表
+    :param action: accept表示接单，reject表示拒单
+    :param reason: 拒单原因
+    :return: (每个订单的处理结果字典, 错误响应)，没有错误时错误响应为None
+    """
+    # 查询请求的订单及其房屋的房东，并锁定订单
+    try:
+        rows = db.session.query(Order.id, Order.status, Order.user_id, Order.house_id, Order.begin_date,
+                                Order.end_date, House.user_id.label('landlord_id'), House.area_id)\
+            .join(House, Order.house_id == House.id)\
+            .filter(Order.id.in_(order_ids)).with_for_update().all()
+    except Exception as e:
+        current_app.logger.error(e)
+        db.session.rollback()
+        return None, jsonify(errno=RET.DBERR, errmsg='查询订单信息失败')
+
+    results = dict((order_id, '订单不存在') for order_id in order_ids)
+    orders = []
+    for order in rows:
+        if order.landlord_id != landlord_id:
+            results[order.id] = '订单不存在'
+        elif order.status != 'WAIT_ACCEPT':
+            results[order.id] = '订单不是待接单状态'
+        else:
+            orders.append(order)
+            results[order.id] = 'OK'
+    if not orders:
+        db.session.rollback()
+        return results, None
+
+    # 一条UPDATE语句修改全部可处理的订单，条件中再次限定订单状态和房东
+    # MySQL的UPDATE不能使用query的join，房东条件使用子查询
+    if action == 'accept':
+        values = {'status': 'WAIT_PAYMENT'}
+    else:
+        values = {'status': 'REJECTED', 'comment': reason}
+    landlord_house_ids = db.session.query(House.id).filter(House.user_id == landlord_id)
+    try:
+        Order.query.filter(Order.id.in_([order.id for order in orders]), Order.status == 'WAIT_ACCEPT',
+                           Order.house_id.in_(landlord_house_ids))\
+            .update(values, synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        current_app.logger.error(e)
+        db.session.rollback()
+        return None, jsonify(errno=RET.DBERR, errmsg='修改订单状态失败')
+
+    # 拒单后释放订单占用的日期，并删除相关的缓存
+    try:
+        for order in orders:
+            if action == 'accept':
+                house_calendar.mark_order_days(order)
+            else:
+                interval_index.remove_order_interval(order, order.area_id)
+                house_calendar.release_order_days(order)
+        if action == 'reject':
+            for area_id in set(order.area_id for order in orders):
+                house_cache.invalidate_house_list(area_id)
+        order_cache.invalidate_user_orders(custom_ids=[order.user_id for order in orders],
+                                           landlord_ids=[landlord_id])
+    except Exception as e:
+        current_app.logger.error(e)
+
+    return results, None
+
+
+@api.route('orders/status', methods=['PUT'])
+@login_required
+def set_orders_status():
+    """
+    房东批量接单或拒单
+    1. 获取参数：订单编号列表order_ids，操作action(accept/reject)，拒单原因reason
+    2. 校验参数，订单数量不能超过constants.ORDER_BULK_MAX_IDS，拒单时必须填写原因
+    3. 只处理房东自己房屋的待接单订单，用一条UPDATE语句完成修改
+    4. 返回每个订单的处理结果
+    :return:
+    """
+    # 1. 获取参数
+    order_data = request.get_json()
+    if not order_data:
+        return jsonify(errno=RET.PARAMERR, errmsg='参数错误')
+    order_ids = order_data.get('order_ids')
+    action = order_data.get('action')
+    reason = order_data.get('reason')
+
+    # 2. 校验参数
+    if not order_ids or not isinstance(order_ids, list) or action not in ('accept', 'reject'):
+        return jsonify(errno=RET.PARAMERR, errmsg='参数错误')
+    if len(order_ids) > constants.ORDER_BULK_MAX_IDS:
+        return jsonify(errno=RET.PARAMERR, errmsg='一次最多处理%s个订单' % constants.ORDER_BULK_MAX_IDS)
+    if action == 'reject' and not reason:
+        return jsonify(errno=RET.PARAMERR, errmsg='请填写拒单原因')
+    try:
+        # 去掉重复的订单编号，保留每个编号第一次出现的位置，结果按请求中的顺序返回
+        unique_ids, seen = [], set()
+        for order_id in order_ids:
+            order_id = int(order_id)
+            if order_id not in seen:
+                seen.add(order_id)
+                unique_ids.append(order_id)
+        order_ids = unique_ids
+    except Exception as e:
+        current_app.logger.error(e)
+        return jsonify(errno=RET.PARAMERR, errmsg='订单编号错误')
+
+    # 3. 批量修改订单状态
+    results, error_resp = _change_orders_status(g.user_id, order_ids, action, reason)
+    if error_resp is not None:
+        return error_resp
+
+    # 4. 返回每个订单的处理结果
+    return jsonify(errno=RET.OK, errmsg='OK',
+                   data={'results': [{'order_id': order_id, 'result': results[order_id]} for order_id in order_ids]})
+
+
+@api.route('orders/<int:order_id>/status', methods=['PUT'])
+@login_required
+def set_order_status(order_id):
+    """
+    房东接单或拒单
+    1. 获取参数：操作action(accept/reject)，拒单原因reason
+    2. 校验参数，拒单时必须填写原因
+    3. 与批量接单拒单使用相同的处理逻辑
+    :param order_id: 订单编号
+    :return:
+    """
+    # 1. 获取参数
+    order_data = request.get_json()
+    if not order_data:
+        return jsonify(errno=RET.PARAMERR, errmsg='参数错误')
+    action = order_data.get('action')
+    reason = order_data.get('reason')
+
+    # 2. 校验参数
+    if action not in ('accept', 'reject'):
+        return jsonify(errno=RET.PARAMERR, errmsg='参数错误')
+    if action == 'reject' and not reason:
+        return jsonify(errno=RET.PARAMERR, errmsg='请填写拒单原因')
+
+    # 3. 修改订单状态
+    results, error_resp = _change_orders_status(g.user_id, [order_id], action, reason)
+    if error_resp is not None:
+        return error_resp
+    if results[order_id] != 'OK':
+        return jsonify(errno=RET.DATAERR, errmsg=results[order_id])
+    return jsonify(errno=RET.OK, errmsg='OK')
+
+
+@api.route('user/orders', methods=['GET'])
+@login_required
+def get_user_orders():
+    """
+    查询用户的订单列表
+    1. 获取参数：角色role，landlord表示查询房东收到的订单，custom表示查询自己下的订单
+    2. 从redis中获取订单列表缓存，没有缓存时只有一个进程查询数据库并写入缓存
+    3. 返回订单列表
+    :return:
+    """
+    # 1. 获取参数
+    user_id = g.user_id
+    role = request.args.get('role', 'custom')
+    if role not in ('landlord', 'custom'):
+        return jsonify(errno=RET.PARAMERR, errmsg='参数错误')
+
+    # 2. 获取订单列表，订单变化后只删除redis中的缓存，不使用进程内缓存
+    orders_json, error_resp, source = get_or_compute(order_cache.user_orders_key(role, user_id),
+                                                     lambda: _query_user_orders(role, user_id),
+                                                     constants.USER_ORDERS_REDIS_EXPIRES, local_ttl=0)
+    if error_resp is not None:
+        return error_resp
+
+    # 3. 返回订单列表
+    return '{"errno":0,"errmsg":"OK","data":{"orders":%s}}' % orders_json, 200, {'Content-Type': 'application/json'}
+
+
+def _query_user_orders(role, user_id):
+    """
+    查询用户的订单列表，订单与房屋信息通过一次联表查询取出
+    :return: (订单列表json数据, 错误响应)
+    """
+    try:
+        if role == 'landlord':
+            # 房东：订单联表房屋，筛选房屋属于自己的订单
+            orders = Order.query.join(House, Order.house_id == House.id)\
+                .filter(House.user_id == user_id)\
+                .options(contains_eager(Order.house))\
+                .order_by(Order.create_time.desc()).all()
+        else:
+            orders = Order.query.filter(Order.user_id == user_id)\
+                .options(joinedload(Order.house))\
+                .order_by(Order.create_time.desc()).all()
+    except Exception as e:
+        current_app.logger.error(e)
+        return None, jsonify(errno=RET.DBERR, errmsg='查询订单信息失败')
+
+    return json.dumps([order.to_dict() for order in orders]), None
+
+
+@api.route('orders/<int:order_id>/comment', methods=['PUT'])
+@login_required
+def set_order_comment(order_id):
+    """
+    评价订单
+    1. 获取参数：评论内容
+    2. 校验评论内容不为空
+    3. 查询当前用户待评价的订单
+    4. 将订单状态改为已完成，保存评论
+    5. 在redis中累加房屋的订单数，由定时任务批量写入数据库
+    6. 将评论加入房屋的评论feed，更新首页排行和订单数排序索引，删除房屋详情和列表缓存
+    7. 返回结果
+    :param order_id: 订单编号
+    :return:
+    """
+    # 1. 获取参数
+    order_data = request.get_json()
+    if not order_data:
+        return jsonify(errno=RET.PARAMERR, errmsg='参数错误')
+    comment = order_data.get('comment')
+
+    # 2. 校验评论内容
+    if not comment:
+        return jsonify(errno=RET.PARAMERR, errmsg='评论内容不能为空')
+
+    # 3. 查询订单，只能评价自己的待评价订单
+    try:
+        order = Order.query.filter_by(id=order_id, user_id=g.user_id, status='WAIT_COMMENT').first()
+    except Exception as e:
+        current_app.logger.error(e)
+        return jsonify(errno=RET.DBERR, errmsg='查询订单信息失败')
+    if not order:
+        return jsonify(errno=RET.NODATA, errmsg='订单不存在或不能评价')
+
+    # 4. 完成订单，保存评论
+    house = order.house
+    order.status = 'COMPLETE'
+    order.comment = comment
+    try:
+        db.session.add(order)
+        db.session.commit()
+    except Exception as e:
+        current_app.logger.error(e)
+        db.session.rollback()
+        return jsonify(errno=RET.DBERR, errmsg='保存评论信息失败')
+
+    # 5. 累加房屋的订单数
+    try:
+        order_count = (house.order_count or 0) + counters.incr_order_count(house.id)
+    except Exception as e:
+        current_app.logger.error(e)
+        # redis不可用时直接更新数据库
+        try:
+            House.query.filter_by(id=house.id).update({House.order_count: House.order_count + 1},
+                                                      synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            current_app.logger.error(e)
+            db.session.rollback()
+        order_count = None
+
+    # 6. 更新redis中房屋相关的缓存
+    try:
+        house_cache.push_house_comment(house.id, order.to_comment_dict())
+        house_cache.update_home_page_house(house, order_count)
+        house_index.update_house_booking(house, order_count)
+        house_cache.invalidate_house_detail(house.id)
+        house_cache.invalidate_house_list(house.area_id)
+        order_cache.invalidate_user_orders(custom_ids=[order.user_id], landlord_ids=[house.user_id])
+    except Exception as e:
+        current_app.logger.error(e)
+
+    return jsonify(errno=RET.OK, errmsg='OK')
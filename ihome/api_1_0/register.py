@@ -1,30 +1,60 @@
 # coding=utf-8
 
 from . import api
-from ihome.utils.captcha.captcha import captcha
 from ihome import redis_store, constants, db
 from flask import current_app, jsonify, make_response, request, session
 from ihome.response_code import RET
 from ihome.models import User
 import re, random
-from ihome.utils import sms
+from ihome.utils import sms, captcha_pool
+from ihome.utils.captcha.captcha import captcha, IMAGE_FORMATS, format_supported
+
+
+@api.before_app_first_request
+def preload_captcha_glyphs():
+    """应用处理第一个请求前，加载图片验证码的字体并生成全部字符的图片"""
+    try:
+        captcha.preload()
+    except Exception as e:
+        current_app.logger.error(e)
 
 
 @api.route('imagecode/<image_code_id>')
 def generate_image_code(image_code_id):
     """
         生成图片验证码:
-        1/调用captcha扩展包,生成图片验证码,name,text,image
-        2/保存图片验证码的内容,使用redis数据库
-        3/返回前端图片
-        4/需要设置响应的类型
+        1/获取参数:图片格式fmt,宽度w,高度h,均为可选,校验格式受支持且大小在允许范围内
+        2/使用默认格式和大小时从验证码池取出预先生成的图片验证码,池为空或指定了格式、大小时调用captcha扩展包生成
+        3/保存图片验证码的内容,使用redis数据库
+        4/返回前端图片
+        5/按图片格式设置响应的类型,禁止缓存
         :param image_code_id:
         :return:
         """
-    # 调用扩展生成图片验证码
-    name, text, image = captcha.generate_captcha()
-    # with open('1.jpg', 'a') as obj:
-    #     obj.write(image)
+    # 获取并校验图片格式和大小
+    fmt = request.args.get('fmt', constants.CAPTCHA_IMAGE_FORMAT).lower()
+    if not format_supported(fmt):
+        return jsonify(errcode=RET.PARAMERR, errmsg='图片格式不支持')
+    try:
+        width = int(request.args.get('w', constants.CAPTCHA_WIDTH))
+        height = int(request.args.get('h', constants.CAPTCHA_HEIGHT))
+    except ValueError:
+        return jsonify(errcode=RET.PARAMERR, errmsg='图片大小错误')
+    if not (constants.CAPTCHA_MIN_WIDTH <= width <= constants.CAPTCHA_MAX_WIDTH and
+            constants.CAPTCHA_MIN_HEIGHT <= height <= constants.CAPTCHA_MAX_HEIGHT):
+        return jsonify(errcode=RET.PARAMERR, errmsg='图片大小超出范围')
+
+    # 从预先生成的验证码池中取出图片验证码，验证码池为空或指定了格式、大小时调用扩展生成
+    pooled = None
+    if (fmt, width, height) == (constants.CAPTCHA_IMAGE_FORMAT, constants.CAPTCHA_WIDTH, constants.CAPTCHA_HEIGHT):
+        try:
+            pooled = captcha_pool.pop_captcha()
+        except Exception as e:
+            current_app.logger.error(e)
+    if pooled:
+        text, image = pooled
+    else:
+        text, image = captcha_pool.render_captcha(fmt, width, height)
 
     try:
         # 保存图片验证码到redis数据库，保存格式为：imagecode_image_code_id, 设置有效期
@@ -34,7 +64,9 @@ def generate_image_code(image_code_id):
         return jsonify(errcode=RET.DBERR, errmsg='保存图片验证码失败')
     else:
         response = make_response(image)
-        response.headers['Content-Type'] = 'image/jpg'
+        response.headers['Content-Type'] = IMAGE_FORMATS[fmt][1]
+        # 验证码每次请求都不同，禁止浏览器和代理缓存
+        response.headers['Cache-Control'] = 'no-store'
         # 返回结果
         return response
 
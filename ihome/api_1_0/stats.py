@@ -0,0 +1,33 @@
+# coding=utf-8
+
+from . import api
+import os
+from flask import current_app, jsonify
+from ihome.response_code import RET
+from ihome.utils.cache import cache_stats
+from ihome.utils.captcha_pool import pool_stats
+
+
+@api.route('cache/stats', methods=['GET'])
+def get_cache_stats():
+    """
+    获取视图缓存的命中和计算次数统计
+    统计保存在各个进程的内存中，返回处理本次请求的进程的统计及其进程号
+    :return:
+    """
+    return jsonify(errno=RET.OK, errmsg='OK', data={'pid': os.getpid(), 'stats': cache_stats()})
+
+
+@api.route('captcha/stats', methods=['GET'])
+def get_captcha_pool_stats():
+    """
+    获取图片验证码池的当前数量、生成速率和命中情况
+    统计保存在redis中，各进程返回相同的结果
+    :return:
+    """
+    try:
+        stats = pool_stats()
+    except Exception as e:
+        current_app.logger.error(e)
+        return jsonify(errno=RET.DBERR, errmsg='查询验证码池统计失败')
+    return jsonify(errno=RET.OK, errmsg='OK', data={'stats': stats})
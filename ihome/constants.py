@@ -29,3 +29,59 @@ HOUSE_LIST_PAGE_CAPACITY = 2
 
 # 房屋列表页面Redis缓存时间，单位：秒
 HOUSE_LIST_REDIS_EXPIRES = 7200
+
+# 用户订单列表的Redis缓存时间，单位：秒
+USER_ORDERS_REDIS_EXPIRES = 3600
+
+# 待接单订单的过期时间，超过该时间未接单的订单自动取消，单位：秒
+ORDER_WAIT_ACCEPT_EXPIRES = 86400
+
+# 待支付订单的过期时间，超过该时间未支付的订单自动取消，单位：秒
+ORDER_WAIT_PAYMENT_EXPIRES = 7200
+
+# 过期订单每批处理的数量
+ORDER_EXPIRY_CHUNK_SIZE = 500
+
+# 过期订单处理任务的租约锁时长，单位：秒
+ORDER_EXPIRY_LEASE_EXPIRES = 60
+
+# 房屋订单数写入数据库任务的租约锁时长，单位：秒
+ORDER_COUNT_FLUSH_LEASE_EXPIRES = 300
+
+# 构建房屋排序索引的租约锁时长，单位：秒
+HOUSE_INDEX_BUILD_LEASE_EXPIRES = 60
+
+# 构建房屋预订日历的租约锁时长，单位：秒
+HOUSE_CALENDAR_BUILD_LEASE_EXPIRES = 60
+
+# 房东批量接单或拒单时一次最多处理的订单数量
+ORDER_BULK_MAX_IDS = 100
+
+# 预先生成的图片验证码数量
+CAPTCHA_POOL_SIZE = 200
+
+# 验证码池的过期时间，修改图片格式或大小后旧的验证码池不再补充，过期后自动删除，单位：秒
+CAPTCHA_POOL_EXPIRES = 86400
+
+# 后台进程检查并补充验证码池的间隔，单位：秒
+CAPTCHA_POOL_REFILL_INTERVAL = 1
+
+# 在请求中生成图片验证码使用的子进程数量，0表示在请求线程中生成
+CAPTCHA_RENDER_PROCESSES = 0
+
+# 图片验证码曲线和噪点的绘制方式：pil或numpy，未安装numpy时使用pil
+CAPTCHA_RENDER_BACKEND = 'pil'
+
+# 图片验证码的默认格式：jpeg、png或webp
+CAPTCHA_IMAGE_FORMAT = 'jpeg'
+
+# jpeg和webp格式图片验证码的压缩质量
+CAPTCHA_IMAGE_QUALITY = 60
+
+# 图片验证码的默认宽度和高度，以及请求中可以指定的范围，单位：像素
+CAPTCHA_WIDTH = 200
+CAPTCHA_HEIGHT = 75
+CAPTCHA_MIN_WIDTH = 100
+CAPTCHA_MAX_WIDTH = 300
+CAPTCHA_MIN_HEIGHT = 40
+CAPTCHA_MAX_HEIGHT = 120
@@ -2,10 +2,31 @@
 
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm.attributes import set_committed_value
 from ihome import constants
 from . import db
 
 
+def preload_many_to_one(objs, relation, model, foreign_key):
+    """
+    批量加载多个对象的多对一关联对象
+    用一次IN查询取出全部关联对象，并直接设置到每个对象的关联属性上，
+    之后访问该属性不会再触发延迟加载查询
+    :param objs: 模型对象列表
+    :param relation: 关联属性名，如"area"
+    :param model: 关联的模型类
+    :param foreign_key: 外键属性名，如"area_id"
+    """
+    ids = set(getattr(obj, foreign_key) for obj in objs
+              if relation not in obj.__dict__ and getattr(obj, foreign_key) is not None)
+    if not ids:
+        return
+    related = dict((item.id, item) for item in model.query.filter(model.id.in_(ids)).all())
+    for obj in objs:
+        if relation not in obj.__dict__:
+            set_committed_value(obj, relation, related.get(getattr(obj, foreign_key)))
+
+
 class BaseModel(object):
     """模型基类，为每个模型补充创建时间与更新时间"""
 
@@ -95,6 +116,15 @@ class House(BaseModel, db.Model):
     """房屋信息"""
 
     __tablename__ = "ih_house_info"
+    __table_args__ = (
+        # 房屋列表按价格、发布时间、订单数排序及游标分页使用的联合索引
+        db.Index("ix_ih_house_info_area_id_price", "area_id", "price", "id"),
+        db.Index("ix_ih_house_info_area_id_create_time", "area_id", "create_time", "id"),
+        db.Index("ix_ih_house_info_area_id_order_count", "area_id", "order_count", "id"),
+        db.Index("ix_ih_house_info_price", "price", "id"),
+        db.Index("ix_ih_house_info_create_time", "create_time", "id"),
+        db.Index("ix_ih_house_info_order_count", "order_count", "id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)  # 房屋编号
     user_id = db.Column(db.Integer, db.ForeignKey("ih_user_profile.id"), nullable=False)  # 房屋主人的用户编号
@@ -132,8 +162,18 @@ class House(BaseModel, db.Model):
         }
         return house_dict
 
-    def to_full_dict(self):
-        """将详细信息转换为字典数据"""
+    @staticmethod
+    def batch_to_basic_dict(houses):
+        """批量将房屋基本信息转换为字典数据，城区和房主信息各只查询一次"""
+        preload_many_to_one(houses, "area", Area, "area_id")
+        preload_many_to_one(houses, "user", User, "user_id")
+        return [house.to_basic_dict() for house in houses]
+
+    def to_full_dict(self, comments=None):
+        """
+        将详细信息转换为字典数据
+        :param comments: 评论列表，通常来自redis中的评论feed，为None时从数据库查询
+        """
         house_dict = {
             "hid": self.id,
             "user_id": self.user_id,
@@ -165,16 +205,11 @@ class House(BaseModel, db.Model):
         house_dict["facilities"] = facilities
 
         # 评论信息
-        comments = []
-        orders = Order.query.filter(Order.house_id == self.id, Order.status == "COMPLETE", Order.comment != None)\
-            .order_by(Order.update_time.desc()).limit(constants.HOUSE_DETAIL_COMMENT_DISPLAY_COUNTS)
-        for order in orders:
-            comment = {
-                "comment": order.comment,  # 评论的内容
-                "user_name": order.user.name if order.user.name != order.user.mobile else "匿名用户",  # 发表评论的用户
-                "ctime": order.update_time.strftime("%Y-%m-%d %H:%M:%S")  # 评价的时间
-            }
-            comments.append(comment)
+        if comments is None:
+            orders = Order.query.filter(Order.house_id == self.id, Order.status == "COMPLETE", Order.comment != None)\
+                .order_by(Order.update_time.desc()).limit(constants.HOUSE_DETAIL_COMMENT_DISPLAY_COUNTS).all()
+            preload_many_to_one(orders, "user", User, "user_id")
+            comments = [order.to_comment_dict() for order in orders]
         house_dict["comments"] = comments
         return house_dict
 
@@ -187,6 +222,14 @@ class Facility(BaseModel, db.Model):
     id = db.Column(db.Integer, primary_key=True)  # 设施编号
     name = db.Column(db.String(32), nullable=False)  # 设施名字
 
+    def to_dict(self):
+        """将对象转换为字典数据"""
+        facility_dict = {
+            "fid": self.id,
+            "fname": self.name
+        }
+        return facility_dict
+
 
 class HouseImage(BaseModel, db.Model):
     """房屋图片"""
@@ -202,6 +245,12 @@ class Order(BaseModel, db.Model):
     """订单"""
 
     __tablename__ = "ih_order_info"
+    __table_args__ = (
+        # 房屋详情页查询已完成订单的评论，按更新时间排序
+        db.Index("ix_ih_order_info_house_id_status_update_time", "house_id", "status", "update_time"),
+        # 用户的订单列表，按创建时间排序
+        db.Index("ix_ih_order_info_user_id_create_time", "user_id", "create_time"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)  # 订单编号
     user_id = db.Column(db.Integer, db.ForeignKey("ih_user_profile.id"), nullable=False)  # 下订单的用户编号
@@ -240,3 +289,19 @@ class Order(BaseModel, db.Model):
         }
         return order_dict
 
+    def to_comment_dict(self):
+        """将订单的评论信息转换为字典数据"""
+        comment_dict = {
+            "comment": self.comment,  # 评论的内容
+            "user_name": self.user.name if self.user.name != self.user.mobile else "匿名用户",  # 发表评论的用户
+            "ctime": self.update_time.strftime("%Y-%m-%d %H:%M:%S")  # 评价的时间
+        }
+        return comment_dict
+
+
+class OrderCountFlush(BaseModel, db.Model):
+    """已写入数据库的房屋订单数增量批次，与订单数在同一事务中写入，避免同一批次重复写入"""
+
+    __tablename__ = "ih_order_count_flush"
+
+    id = db.Column(db.String(32), primary_key=True)  # 批次编号
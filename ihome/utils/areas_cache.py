@@ -0,0 +1,98 @@
+# coding=utf-8
+"""
+城区信息的两级缓存
+
+城区数据几乎不会变化。redis中保存城区数据的json以及版本号(json的md5)，
+每个进程在内存中保存最终的响应数据、gzip压缩后的数据和ETag。
+处理请求时只从redis中读取版本号，版本号未变化时直接使用内存中的响应数据
+"""
+
+import gzip
+import hashlib
+import json
+from cStringIO import StringIO
+
+from ihome import redis_store, constants
+
+
+# 城区数据的json
+AREAS_KEY = 'areas'
+# 城区数据的版本号
+AREAS_VERSION_KEY = 'areas_version'
+
+# 进程内的缓存，字段：version, body, gzip_body, etag，更新时整体替换，读取时不需要加锁
+_local = {}
+
+
+def _gzip(data):
+    """gzip压缩数据"""
+    out = StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def _load_local(version, area_json):
+    """根据城区数据的json构造进程内的响应缓存"""
+    body = '{"errno":0,"errmsg":"OK","data":%s}' % area_json
+    local = {
+        'version': version,
+        'body': body,
+        'gzip_body': _gzip(body),
+        'etag': version,
+    }
+    global _local
+    _local = local
+    return local
+
+
+def _load_areas_from_db():
+    """从数据库中查询城区信息，保存到redis中，没有城区信息时返回None"""
+    from ihome.models import Area
+    areas = Area.query.all()
+    if not areas:
+        return None, None
+    area_json = json.dumps([area.to_dict() for area in areas])
+    version = hashlib.md5(area_json).hexdigest()
+    try:
+        pipeline = redis_store.pipeline()
+        pipeline.setex(AREAS_KEY, constants.AREA_INFO_REDIS_EXPIRES, area_json)
+        pipeline.setex(AREAS_VERSION_KEY, constants.AREA_INFO_REDIS_EXPIRES, version)
+        pipeline.execute()
+    except Exception:
+        # redis不可用时，仍然可以使用数据库中的数据
+        pass
+    return version, area_json
+
+
+def get_areas_response():
+    """
+    获取城区信息的响应缓存
+    1. 从redis中读取版本号，与进程内的缓存一致时直接返回
+    2. 版本号变化时从redis中读取城区数据，重新构造进程内的缓存
+    3. redis中没有数据时查询数据库，redis不可用时使用进程内已有的缓存
+    :return: 字典，字段为version, body, gzip_body, etag；没有城区信息时返回None
+    """
+    local = _local
+    try:
+        version = redis_store.get(AREAS_VERSION_KEY)
+    except Exception:
+        # redis不可用时，继续使用进程内已加载的缓存
+        if local:
+            return local
+        version = None
+
+    if version and local.get('version') == version:
+        return local
+
+    area_json = None
+    if version:
+        try:
+            area_json = redis_store.get(AREAS_KEY)
+        except Exception:
+            area_json = None
+    if not area_json:
+        version, area_json = _load_areas_from_db()
+        if not area_json:
+            return None
+    return _load_local(version, area_json)
@@ -0,0 +1,233 @@
+# coding=utf-8
+"""
+通用的读缓存
+
+get_or_compute使用两级缓存：进程内带过期时间的LRU缓存，其后为redis。
+两级缓存都没有数据时，只有获得redis锁的进程重新计算，其他进程等待计算结果，
+避免缓存过期时所有进程同时查询数据库。
+缓存快过期时按概率提前重新计算(XFetch)，计算越耗时、越接近过期，提前计算的概率越大。
+视图可以直接调用get_or_compute缓存响应中的数据，或使用@cached_view装饰器缓存整个响应
+"""
+
+import functools
+import json
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request, make_response
+
+from ihome import redis_store
+from ihome.utils.redis_lock import RedisLease
+
+
+# 等待其他进程计算结果的最长时间，单位：秒
+SINGLE_FLIGHT_WAIT = 2.0
+# 等待时查询redis的间隔，单位：秒
+SINGLE_FLIGHT_INTERVAL = 0.05
+# 提前重新计算的系数，越大越早重新计算
+EARLY_REFRESH_BETA = 1.0
+
+# 命中和计算次数的统计：进程内命中、redis命中、未命中、重新计算、提前重新计算、等待其他进程计算
+_stats = {
+    'local_hit': 0,
+    'redis_hit': 0,
+    'miss': 0,
+    'recompute': 0,
+    'early_refresh': 0,
+    'wait': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def cache_stats():
+    """返回当前进程的缓存命中和计算次数统计"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+class LRUCache(object):
+    """带过期时间的进程内LRU缓存"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """获取缓存，不存在或已过期时返回None"""
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at <= time.time():
+                return None
+            # 重新插入，移动到最近使用的位置
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+local_cache = LRUCache()
+
+
+def _cache_key(prefix, key_func, args, kwargs):
+    if key_func is not None:
+        return 'cache_%s_%s' % (prefix, key_func(*args, **kwargs))
+    return 'cache_%s_%s' % (prefix, request.full_path)
+
+
+def _is_ok(response):
+    """只缓存成功的响应，errno不为0的错误信息不缓存"""
+    if response.status_code != 200:
+        return False
+    try:
+        return str(json.loads(response.get_data()).get('errno')) == '0'
+    except Exception:
+        return False
+
+
+def _should_refresh_early(delta, expires_at):
+    """XFetch：根据计算耗时和剩余时间，按概率决定是否提前重新计算"""
+    return time.time() - delta * EARLY_REFRESH_BETA * math.log(random.random() or 1e-12) >= expires_at
+
+
+def _store(key, value, delta, ttl, local_ttl):
+    expires_at = time.time() + ttl
+    pipeline = redis_store.pipeline()
+    pipeline.hmset(key, {'value': value, 'delta': delta, 'expires_at': expires_at})
+    pipeline.expire(key, ttl)
+    pipeline.execute()
+    local_cache.set(key, value, min(local_ttl, ttl))
+
+
+def _compute(key, compute, ttl, local_ttl):
+    """调用compute计算，没有不缓存的响应时写入两级缓存"""
+    _count('recompute')
+    start = time.time()
+    value, error_resp = compute()
+    if error_resp is None:
+        try:
+            _store(key, value, time.time() - start, ttl, local_ttl)
+        except Exception as e:
+            current_app.logger.error(e)
+    return value, error_resp
+
+
+def get_or_compute(key, compute, ttl, local_ttl=5):
+    """
+    两级缓存读取，两级缓存都没有数据时只有获得redis锁的进程调用compute重新计算
+    1. 进程内缓存
+    2. redis缓存，快过期时按概率提前重新计算
+    3. 获得锁的进程重新计算，其他进程有旧数据时返回旧数据，否则等待计算结果
+    :param key: redis中的缓存键名
+    :param compute: 计算函数，返回(要缓存的字符串, 不缓存的响应)，第二项不为None时不写入缓存，例如错误信息
+    :param ttl: redis中的缓存时间，单位：秒
+    :param local_ttl: 进程内的缓存时间，单位：秒，为0时不使用进程内缓存
+    :return: (字符串, 不缓存的响应, 数据来源)，数据来源为HIT-LOCAL, HIT, STALE或MISS
+    """
+    # 1. 进程内缓存
+    value = local_cache.get(key)
+    if value is not None:
+        _count('local_hit')
+        return value, None, 'HIT-LOCAL'
+
+    # 2. redis缓存
+    try:
+        cached = redis_store.hgetall(key)
+    except Exception as e:
+        current_app.logger.error(e)
+        value, error_resp = compute()
+        return value, error_resp, 'MISS'
+    if cached:
+        value = cached['value']
+        if not _should_refresh_early(float(cached['delta']), float(cached['expires_at'])):
+            _count('redis_hit')
+            local_cache.set(key, value, local_ttl)
+            return value, None, 'HIT'
+        _count('early_refresh')
+    else:
+        _count('miss')
+
+    # 3. 只有获得锁的进程重新计算
+    lease = RedisLease(key, SINGLE_FLIGHT_WAIT * 2)
+    if not lease.acquire():
+        # 已有旧数据时直接使用旧数据
+        if cached:
+            return value, None, 'STALE'
+        # 等待其他进程的计算结果，超时后自行计算
+        _count('wait')
+        deadline = time.time() + SINGLE_FLIGHT_WAIT
+        while time.time() < deadline:
+            time.sleep(SINGLE_FLIGHT_INTERVAL)
+            value = redis_store.hget(key, 'value')
+            if value is not None:
+                local_cache.set(key, value, local_ttl)
+                return value, None, 'HIT'
+
+    try:
+        value, error_resp = _compute(key, compute, ttl, local_ttl)
+        return value, error_resp, 'MISS'
+    finally:
+        lease.release()
+
+
+def cached_view(prefix, ttl, local_ttl=5, key_func=None):
+    """
+    视图缓存装饰器，缓存成功的json响应
+    :param prefix: 缓存键名前缀
+    :param ttl: redis中的缓存时间，单位：秒
+    :param local_ttl: 进程内的缓存时间，单位：秒
+    :param key_func: 根据视图参数生成缓存键名的函数，默认使用请求的路径和查询字符串
+    """
+    def decorator(view_func):
+
+        @functools.wraps(view_func)
+        def wrapper(*args, **kwargs):
+            def compute():
+                response = make_response(view_func(*args, **kwargs))
+                if not _is_ok(response):
+                    return None, response
+                return response.get_data(), None
+
+            value, error_resp, source = get_or_compute(_cache_key(prefix, key_func, args, kwargs),
+                                                       compute, ttl, local_ttl)
+            if error_resp is not None:
+                return error_resp
+            response = make_response(value)
+            response.headers['Content-Type'] = 'application/json'
+            response.headers['X-Cache'] = source
+            return response
+
+        return wrapper
+    return decorator
+
+
+def invalidate(key):
+    """删除缓存，其他进程的进程内缓存在local_ttl后过期"""
+    local_cache.delete(key)
+    redis_store.delete(key)
@@ -3,9 +3,13 @@
 
 # refer to `https://bitbucket.org/akorn/wheezy.captcha`
 
+import logging
 import random
 import string
 import os.path
+import multiprocessing
+import threading
+import time
 from cStringIO import StringIO
 
 from PIL import Image
@@ -13,11 +17,40 @@ from PIL import ImageFilter
 from PIL.ImageDraw import Draw
 from PIL.ImageFont import truetype
 
+try:
+    import numpy
+except ImportError:
+    # the 'numpy' backend falls back to 'pil' without numpy
+    numpy = None
+
+BACKENDS = ('pil', 'numpy')
+
+_numpy_fallback_warned = []
+
+
+def _warn_numpy_fallback():
+    """ Log once per process that the 'numpy' backend renders with 'pil'. """
+    if not _numpy_fallback_warned:
+        _numpy_fallback_warned.append(True)
+        logging.getLogger(__name__).warning(
+            'numpy is not installed, captcha backend falls back to pil')
+
+
+# output formats: name -> (PIL format, content type)
+IMAGE_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+}
+# height the default font sizes are designed for
+DEFAULT_HEIGHT = 75
+
 
 class Bezier:
     def __init__(self):
         self.tsequence = tuple([t / 20.0 for t in range(21)])
         self.beziers = {}
+        self.bezier_arrays = {}
 
     def pascal_row(self, n):
         """ Returns n-th row of Pascal's triangle
@@ -53,12 +86,91 @@ class Bezier:
             self.beziers[n] = result
             return result
 
+    def make_bezier_array(self, n):
+        """ The coefficient table of make_bezier as a numpy array of
+            shape (len(tsequence), n), computed in one broadcast.
+        """
+        try:
+            return self.bezier_arrays[n]
+        except KeyError:
+            t = numpy.array(self.tsequence)[:, numpy.newaxis]
+            i = numpy.arange(n)
+            result = numpy.array(self.pascal_row(n - 1)) * t ** i * (1 - t) ** (n - 1 - i)
+            self.bezier_arrays[n] = result
+            return result
+
+
+# characters used by random captcha texts
+ALPHABET = string.uppercase + '3456789'
+DEFAULT_FONT_SIZES = (65, 70, 75)
+
+# process-wide caches shared by all renders:
+# (path, size) -> FreeType font, (path, size, char) -> cropped glyph image
+_fonts = {}
+_glyphs = {}
+_cache_lock = threading.Lock()
+
+
+def get_font(path, size):
+    """Return the FreeType font for (path, size), parsing the file only once."""
+    key = (path, size)
+    font = _fonts.get(key)
+    if font is None:
+        with _cache_lock:
+            font = _fonts.get(key)
+            if font is None:
+                font = _fonts[key] = truetype(path, size)
+    return font
+
+
+def get_glyph(path, size, char):
+    """Return the cropped white-on-black image of char, rendered only once.
+
+    Callers must not modify the returned image in place.
+    """
+    key = (path, size, char)
+    glyph = _glyphs.get(key)
+    if glyph is None:
+        font = get_font(path, size)
+        c_width, c_height = Draw(Image.new('RGB', (1, 1))).textsize(char, font=font)
+        glyph = Image.new('RGB', (c_width, c_height), (0, 0, 0))
+        Draw(glyph).text((0, 0), char, font=font, fill=(255, 255, 255))
+        glyph = glyph.crop(glyph.getbbox())
+        _glyphs[key] = glyph
+    return glyph
+
+
+def clear_caches():
+    """Drop all cached fonts and glyphs."""
+    with _cache_lock:
+        _fonts.clear()
+        _glyphs.clear()
+
+
+class RenderContext(object):
+    """Settings of a single render.
+
+    Every render gets its own context, so concurrent renders on the shared
+    Captcha instance never overwrite each other's text or color.
+    """
+    __slots__ = ('text', 'fonts', 'width', 'height', 'color', 'backend')
+
+    def __init__(self, text, fonts, width, height, color, backend):
+        self.text = text
+        self.fonts = fonts
+        self.width = width
+        self.height = height
+        self.color = color
+        self.backend = backend
+
 
 class Captcha(object):
     def __init__(self):
         self._bezier = Bezier()
         self._dir = os.path.dirname(__file__)
         # self._captcha_path = os.path.join(self._dir, '..', 'static', 'captcha')
+        self.fonts = tuple(os.path.join(self._dir, 'fonts', font)
+                           for font in ['Arial.ttf', 'Georgia.ttf', 'actionj.ttf'])
 
     @staticmethod
     def instance():
@@ -66,14 +178,24 @@ class Captcha(object):
             Captcha._instance = Captcha()
         return Captcha._instance
 
-    def initialize(self, width=200, height=75, color=None, text=None, fonts=None):
-        # self.image = Image.new('RGB', (width, height), (255, 255, 255))
-        self._text = text if text else random.sample(string.uppercase + string.uppercase + '3456789', 4)
-        self.fonts = fonts if fonts else \
-            [os.path.join(self._dir, 'fonts', font) for font in ['Arial.ttf', 'Georgia.ttf', 'actionj.ttf']]
-        self.width = width
-        self.height = height
-        self._color = color if color else self.random_color(0, 200, random.randint(220, 255))
+    def initialize(self, width=200, height=75, color=None, text=None, fonts=None, backend='pil'):
+        """Return a new RenderContext, the instance itself is not modified.
+
+        backend: 'pil' draws curve and noise with ImageDraw, 'numpy' computes
+        them with array operations; 'numpy' falls back to 'pil' when numpy
+        is not installed.
+        """
+        if backend not in BACKENDS:
+            raise ValueError('unknown captcha backend: %s' % backend)
+        if backend == 'numpy' and numpy is None:
+            _warn_numpy_fallback()
+        return RenderContext(
+            text=text if text else random.sample(string.uppercase + ALPHABET, 4),
+            fonts=fonts if fonts else self.fonts,
+            width=width,
+            height=height,
+            color=color if color else self.random_color(0, 200, random.randint(220, 255)),
+            backend=backend if numpy is not None else 'pil')
 
     @staticmethod
     def random_color(start, end, opacity=None):
@@ -104,10 +226,11 @@ class Captcha(object):
         for coefs in bcoefs:
             points.append(tuple(sum([coef * p for coef, p in zip(coefs, ps)])
                                 for ps in zip(*path)))
-        Draw(image).line(points, fill=color if color else self._color, width=width)
+        Draw(image).line(points, fill=color if color else self.random_color(0, 200), width=width)
         return image
 
     def noise(self, image, number=50, level=2, color=None):
+        color = color if color else self.random_color(0, 200)
         width, height = image.size
         dx = width / 10
         width -= dx
@@ -117,23 +240,54 @@ class Captcha(object):
         for i in xrange(number):
             x = int(random.uniform(dx, width))
             y = int(random.uniform(dy, height))
-            draw.line(((x, y), (x + level, y)), fill=color if color else self._color, width=level)
+            draw.line(((x, y), (x + level, y)), fill=color, width=level)
         return image
 
-    def text(self, image, fonts, font_sizes=None, drawings=None, squeeze_factor=0.75, color=None):
-        color = color if color else self._color
-        fonts = tuple([truetype(name, size)
+    def curve_numpy(self, image, width=4, number=6, color=None):
+        """curve() with the points computed as one matrix product."""
+        dx, height = image.size
+        dx /= number
+        path = numpy.empty((number - 1, 2))
+        path[:, 0] = numpy.arange(1, number) * dx
+        path[:, 1] = numpy.random.randint(0, height + 1, number - 1)
+        points = self._bezier.make_bezier_array(number - 1).dot(path)
+        Draw(image).line([tuple(point) for point in points.tolist()],
+                         fill=color if color else self.random_color(0, 200), width=width)
+        return image
+
+    def noise_numpy(self, image, number=50, level=2, color=None):
+        """noise() with all dots written into the image buffer at once."""
+        color = color if color else self.random_color(0, 200)
+        width, height = image.size
+        dx = width / 10
+        dy = height / 10
+        xs = numpy.random.uniform(dx, width - dx, number).astype(int)
+        ys = numpy.random.uniform(dy, height - dy, number).astype(int)
+        # each dot is the level-wide line from (x, y) to (x + level, y)
+        rows = (ys[:, numpy.newaxis] + numpy.arange(level) - level // 2).repeat(level + 1, axis=1)
+        cols = numpy.tile(xs[:, numpy.newaxis] + numpy.arange(level + 1), level)
+        pixels = numpy.array(image)
+        pixels[rows.clip(0, height - 1), cols.clip(0, width - 1)] = color[:3]
+        return Image.fromarray(pixels)
+
+    def preload(self, fonts=None, font_sizes=None, alphabet=ALPHABET):
+        """Parse the fonts and render the glyphs of alphabet ahead of time."""
+        fonts = fonts or self.fonts
+        for name in fonts:
+            for size in font_sizes or DEFAULT_FONT_SIZES:
+                for c in alphabet:
+                    get_glyph(name, size, c)
+
+    def text(self, image, fonts, font_sizes=None, drawings=None, squeeze_factor=0.75, color=None, chars=None):
+        color = color if color else self.random_color(0, 200)
+        chars = chars if chars else random.sample(ALPHABET, 4)
+        fonts = tuple([(name, size)
                        for name in fonts
-                       for size in font_sizes or (65, 70, 75)])
-        draw = Draw(image)
+                       for size in font_sizes or DEFAULT_FONT_SIZES])
         char_images = []
-        for c in self._text:
-            font = random.choice(fonts)
-            c_width, c_height = draw.textsize(c, font=font)
-            char_image = Image.new('RGB', (c_width, c_height), (0, 0, 0))
-            char_draw = Draw(char_image)
-            char_draw.text((0, 0), c, font=font, fill=color)
-            char_image = char_image.crop(char_image.getbbox())
+        for c in chars:
+            name, size = random.choice(fonts)
+            char_image = get_glyph(name, size, c)
             for drawing in drawings:
                 d = getattr(self, drawing)
                 char_image = d(char_image)
@@ -142,10 +296,14 @@ class Captcha(object):
         offset = int((width - sum(int(i.size[0] * squeeze_factor)
                                   for i in char_images[:-1]) -
                       char_images[-1].size[0]) / 2)
+        # glyphs are cached in white, scale the mask by the luminance of the
+        # text color so it matches a glyph drawn in that color
+        red, green, blue = color[:3]
+        scale = (red * 299 + green * 587 + blue * 114) / 1000.0 / 255 * 1.97
         for char_image in char_images:
             c_width, c_height = char_image.size
-            mask = char_image.convert('L').point(lambda i: i * 1.97)
-            image.paste(char_image,
+            mask = char_image.convert('L').point(lambda i: i * scale)
+            image.paste(color[:3],
                         (offset, int((height - c_height) / 2)),
                         mask)
             offset += int(c_width * squeeze_factor)
@@ -187,37 +345,154 @@ class Captcha(object):
         return image.rotate(
             random.uniform(-angle, angle), Image.BILINEAR, expand=1)
 
-    def captcha(self, path=None, fmt='JPEG'):
+    @staticmethod
+    def encode(image, fmt='JPEG', quality=None, colors=32):
+        """Encode image, PNG is quantized to a palette of colors first."""
+        out = StringIO()
+        if fmt == 'PNG':
+            image.quantize(colors).save(out, format=fmt, optimize=True)
+        elif quality:
+            image.save(out, format=fmt, quality=quality)
+        else:
+            image.save(out, format=fmt)
+        return out.getvalue()
+
+    def captcha(self, path=None, fmt='JPEG', context=None, quality=None):
         """Create a captcha.
 
         Args:
             path: save path, default None.
-            fmt: image format, PNG / JPEG.
+            fmt: image format, PNG / JPEG / WEBP.
+            context: RenderContext of this render, default a new random one.
+            quality: JPEG / WEBP quality, default the PIL default.
         Returns:
             A tuple, (name, text, StringIO.value).
             For example:
                 ('fXZJN4AFxHGoU5mIlcsdOypa', 'JGW9', '\x89PNG\r\n\x1a\n\x00\x00\x00\r...')
 
         """
-        image = Image.new('RGB', (self.width, self.height), (255, 255, 255))
-        image = self.background(image)
-        image = self.text(image, self.fonts, drawings=['warp', 'rotate', 'offset'])
-        image = self.curve(image)
-        image = self.noise(image)
-        image = self.smooth(image)
+        context = context or self.initialize()
+        image = self.render(context)
         name = "".join(random.sample(string.lowercase + string.uppercase + '3456789', 24))
-        text = "".join(self._text)
-        out = StringIO()
-        image.save(out, format=fmt)
+        text = "".join(context.text)
+        data = self.encode(image, fmt, quality)
         if path:
-            image.save(os.path.join(path, name), fmt)
-        return name, text, out.getvalue()
+            with open(os.path.join(path, name), 'wb') as f:
+                f.write(data)
+        return name, text, data
 
-    def generate_captcha(self):
-        self.initialize()
-        return self.captcha("")
+    def render(self, context):
+        """Draw the captcha of context, returns the unencoded image."""
+        image = Image.new('RGB', (context.width, context.height), (255, 255, 255))
+        image = self.background(image)
+        # scale the font sizes with the image height
+        font_sizes = tuple(size * context.height // DEFAULT_HEIGHT for size in DEFAULT_FONT_SIZES)
+        image = self.text(image, context.fonts, font_sizes=font_sizes, drawings=['warp', 'rotate', 'offset'],
+                          color=context.color, chars=context.text)
+        if context.backend == 'numpy':
+            image = self.curve_numpy(image, color=context.color)
+            image = self.noise_numpy(image, color=context.color)
+        else:
+            image = self.curve(image, color=context.color)
+            image = self.noise(image, color=context.color)
+        return self.smooth(image)
+
+    def generate_captcha(self, fmt='JPEG', quality=None, **kwargs):
+        """Render a captcha, safe to call from concurrent threads.
+
+        kwargs are passed to initialize().
+        """
+        return self.captcha("", fmt=fmt, context=self.initialize(**kwargs), quality=quality)
 
 captcha = Captcha.instance()
 
+
+def format_supported(fmt):
+    """Whether the installed PIL can encode the output format name."""
+    Image.init()
+    return fmt in IMAGE_FORMATS and IMAGE_FORMATS[fmt][0] in Image.SAVE
+
+# processes rendering captchas for generate_captcha_in_process
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _seed_worker():
+    # forked workers start with the parent's random state, reseed them
+    random.seed()
+    if numpy is not None:
+        numpy.random.seed()
+    captcha.preload()
+
+
+def _render_in_worker(kwargs):
+    return captcha.generate_captcha(**kwargs)
+
+
+def generate_captcha_in_process(processes, timeout=5, **kwargs):
+    """Render a captcha in a pool of worker processes.
+
+    The pool is created on first use in each process. Rendering there keeps
+    the CPU work off the GIL of the calling process.
+    """
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                _process_pool = multiprocessing.Pool(processes, initializer=_seed_worker)
+    # a timeout on get() also keeps the call interruptible in python 2
+    return _process_pool.apply_async(_render_in_worker, (kwargs,)).get(timeout)
+
+
+
+def benchmark(number=200):
+    """Compare captchas/sec with cold font and glyph caches against warm caches."""
+    start = time.time()
+    for i in xrange(number):
+        clear_caches()
+        captcha.generate_captcha()
+    cold = number / (time.time() - start)
+
+    captcha.preload()
+    start = time.time()
+    for i in xrange(number):
+        captcha.generate_captcha()
+    warm = number / (time.time() - start)
+    print 'cold caches: %.1f captchas/sec' % cold
+    print 'warm caches: %.1f captchas/sec (x%.2f)' % (warm, warm / cold)
+
+
+def benchmark_backends(number=200):
+    """Compare captchas/sec of the rendering backends with warm caches."""
+    captcha.preload()
+    for backend in BACKENDS:
+        if backend == 'numpy' and numpy is None:
+            print '%s: not installed' % backend
+            continue
+        start = time.time()
+        for i in xrange(number):
+            captcha.generate_captcha(backend=backend)
+        print '%s: %.1f captchas/sec' % (backend, number / (time.time() - start))
+
+
+def benchmark_formats(number=50):
+    """Compare bytes per image and encode time of the output formats."""
+    images = [captcha.render(captcha.initialize()) for i in xrange(number)]
+
+    for name, quality in (('jpeg', None), ('jpeg', 60), ('jpeg', 40), ('png', None),
+                          ('webp', None), ('webp', 60)):
+        if not format_supported(name):
+            print '%s: not supported by this PIL' % name
+            continue
+        fmt = IMAGE_FORMATS[name][0]
+        start = time.time()
+        size = sum(len(Captcha.encode(image, fmt, quality)) for image in images)
+        elapsed = time.time() - start
+        print '%-5s quality=%-4s %6d bytes/image %6.2f ms/encode' % (
+            name, quality or '-', size // number, elapsed * 1000 / number)
+
+
 if __name__ == '__main__':
-    print captcha.generate_captcha()
+    benchmark()
+    benchmark_backends()
+    benchmark_formats()
@@ -0,0 +1,136 @@
+# coding=utf-8
+"""
+预先生成的图片验证码池
+
+生成图片验证码需要对每个字符做扭曲、旋转、平移，再画曲线、噪点、平滑并编码为图片，
+每次需要几十毫秒的CPU时间。由后台进程(manage.py fill_captcha_pool)预先生成验证码，
+保存在redis的列表中，接口直接取出一个使用，列表为空时才在请求中生成。
+
+列表的元素为"验证码文字|图片数据"，验证码文字中不包含"|"。
+列表的键名中包含图片的格式、质量和大小，修改这些配置后不会取出旧格式的图片，旧列表过期后自动删除
+"""
+
+import time
+
+from flask import current_app
+
+from ihome import redis_store, constants
+
+
+# 预先生成的验证码列表的键名前缀
+CAPTCHA_POOL_KEY = 'captcha_pool'
+# 验证码池的统计，hash，字段：produced(生成数量), pool_hits(从池中取出的数量),
+# pool_misses(池为空时在请求中生成的数量), refill_rate(最近一次补充时每秒生成的数量), refilled_at(最近一次补充的时间)
+CAPTCHA_POOL_STATS_KEY = 'captcha_pool_stats'
+
+
+def _render_options(fmt=None, width=None, height=None):
+    """生成验证码的参数，未指定的参数使用constants中的默认值"""
+    from ihome.utils.captcha.captcha import IMAGE_FORMATS
+    return {
+        'fmt': IMAGE_FORMATS[fmt or constants.CAPTCHA_IMAGE_FORMAT][0],
+        'quality': constants.CAPTCHA_IMAGE_QUALITY,
+        'width': width or constants.CAPTCHA_WIDTH,
+        'height': height or constants.CAPTCHA_HEIGHT,
+        'backend': constants.CAPTCHA_RENDER_BACKEND,
+    }
+
+
+def _pool_key():
+    """当前配置的验证码列表的键名，包含图片的格式、质量和大小"""
+    options = _render_options()
+    return '%s_%s_%s_%sx%s' % (CAPTCHA_POOL_KEY, options['fmt'], options['quality'],
+                               options['width'], options['height'])
+
+
+def _render():
+    """生成一个默认格式和大小的验证码，返回(验证码文字, 图片数据)"""
+    from ihome.utils.captcha.captcha import captcha
+    name, text, image = captcha.generate_captcha(**_render_options())
+    return text, image
+
+
+def render_captcha(fmt=None, width=None, height=None):
+    """
+    验证码池为空或请求指定了格式、大小时在请求中生成验证码
+    constants.CAPTCHA_RENDER_PROCESSES大于0时在子进程中生成，不占用请求进程的GIL
+    :return: (验证码文字, 图片数据)
+    """
+    from ihome.utils.captcha.captcha import captcha, generate_captcha_in_process
+    options = _render_options(fmt, width, height)
+    if constants.CAPTCHA_RENDER_PROCESSES:
+        try:
+            name, text, image = generate_captcha_in_process(constants.CAPTCHA_RENDER_PROCESSES, **options)
+            return text, image
+        except Exception as e:
+            # 子进程超时或异常时在当前线程中生成
+            current_app.logger.error(e)
+    name, text, image = captcha.generate_captcha(**options)
+    return text, image
+
+
+def fill_pool(size=None, batch_size=20):
+    """
+    将验证码池补充到指定数量，每生成batch_size个写入一次redis，接口可以尽早取到新的验证码
+    :param size: 验证码池的目标数量，默认为constants.CAPTCHA_POOL_SIZE
+    :return: 本次生成的验证码数量
+    """
+    from ihome.utils.captcha.captcha import captcha
+    size = size or constants.CAPTCHA_POOL_SIZE
+    pool_key = _pool_key()
+    missing = size - redis_store.llen(pool_key)
+    if missing <= 0:
+        return 0
+    # 预先加载字体和字符图片，已加载时直接返回
+    captcha.preload()
+
+    start = time.time()
+    produced = 0
+    while produced < missing:
+        items = []
+        for i in xrange(min(batch_size, missing - produced)):
+            text, image = _render()
+            items.append('%s|%s' % (text, image))
+        pipeline = redis_store.pipeline()
+        pipeline.rpush(pool_key, *items)
+        # 多个后台进程同时补充时，只保留目标数量
+        pipeline.ltrim(pool_key, 0, size - 1)
+        # 配置修改后不再补充的旧列表过期后自动删除
+        pipeline.expire(pool_key, constants.CAPTCHA_POOL_EXPIRES)
+        pipeline.hincrby(CAPTCHA_POOL_STATS_KEY, 'produced', len(items))
+        pipeline.execute()
+        produced += len(items)
+
+    elapsed = time.time() - start
+    pipeline = redis_store.pipeline()
+    pipeline.hset(CAPTCHA_POOL_STATS_KEY, 'refill_rate', '%.1f' % (produced / elapsed if elapsed else 0))
+    pipeline.hset(CAPTCHA_POOL_STATS_KEY, 'refilled_at', int(time.time()))
+    pipeline.execute()
+    return produced
+
+
+def pop_captcha():
+    """
+    从验证码池中取出一个验证码
+    :return: (验证码文字, 图片数据)，验证码池为空时返回None
+    """
+    item = redis_store.lpop(_pool_key())
+    if item is None:
+        redis_store.hincrby(CAPTCHA_POOL_STATS_KEY, 'pool_misses', 1)
+        return None
+    redis_store.hincrby(CAPTCHA_POOL_STATS_KEY, 'pool_hits', 1)
+    text, image = item.split('|', 1)
+    return text, image
+
+
+def pool_stats():
+    """
+    验证码池的统计信息
+    :return: 字典，字段为size(当前数量)以及CAPTCHA_POOL_STATS_KEY中的字段
+    """
+    pipeline = redis_store.pipeline()
+    pipeline.llen(_pool_key())
+    pipeline.hgetall(CAPTCHA_POOL_STATS_KEY)
+    size, stats = pipeline.execute()
+    stats['size'] = size
+    return stats
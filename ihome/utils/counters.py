@@ -0,0 +1,118 @@
+# coding=utf-8
+"""
+房屋订单数的缓冲计数
+
+订单完成时不直接修改ih_house_info中的order_count，而是在redis的hash中累加，
+由定时任务(manage.py flush_order_counts)将累加的数量用一条
+UPDATE ... CASE语句批量写入数据库，避免热门房屋的行被频繁更新
+"""
+
+import uuid
+from datetime import datetime, timedelta
+
+from redis.exceptions import ResponseError
+from sqlalchemy import case, func
+
+from ihome import db, redis_store, constants
+from ihome.utils.redis_lock import RedisLease
+
+
+# 待写入数据库的订单数增量，hash，字段为房屋编号
+ORDER_COUNT_BUFFER_KEY = 'house_order_count_buffer'
+# 正在写入数据库的订单数增量，写入失败时保留，下次优先写入
+ORDER_COUNT_FLUSHING_KEY = 'house_order_count_flushing'
+# 正在写入的增量hash中保存批次编号的字段
+FLUSH_ID_FIELD = 'flush_id'
+# 已写入批次记录的保留时间
+FLUSH_RECORD_KEEP = timedelta(days=7)
+
+
+def incr_order_count(house_id, amount=1):
+    """
+    累加房屋的订单数
+    :return: 该房屋尚未写入数据库的订单数增量
+    """
+    return redis_store.hincrby(ORDER_COUNT_BUFFER_KEY, house_id, amount)
+
+
+def get_buffered_order_count(house_id):
+    """获取房屋尚未写入数据库的订单数增量"""
+    return int(redis_store.hget(ORDER_COUNT_BUFFER_KEY, house_id) or 0)
+
+
+def flush_order_counts():
+    """
+    将累加的订单数批量写入数据库，同一时间只有一个进程执行
+    先将缓冲hash改名，之后的累加写入新的hash，不会丢失。
+    每个批次有一个编号，与订单数在同一事务中写入ih_order_count_flush，
+    写入数据库后、删除redis中的批次前崩溃时，重试只删除批次，不会重复累加
+    :return: 更新的房屋数量，其他进程正在执行时返回None
+    """
+    lease = RedisLease('order_count_flush', constants.ORDER_COUNT_FLUSH_LEASE_EXPIRES)
+    if not lease.acquire():
+        return None
+    try:
+        return _flush_order_counts()
+    finally:
+        lease.release()
+
+
+def _flush_order_counts():
+    from ihome.models import House, OrderCountFlush
+    if not redis_store.exists(ORDER_COUNT_FLUSHING_KEY):
+        try:
+            redis_store.rename(ORDER_COUNT_BUFFER_KEY, ORDER_COUNT_FLUSHING_KEY)
+        except ResponseError:
+            # 缓冲hash不存在，没有需要写入的数据
+            return 0
+    # 批次编号在改名后第一次写入时生成，重试时沿用
+    redis_store.hsetnx(ORDER_COUNT_FLUSHING_KEY, FLUSH_ID_FIELD, uuid.uuid4().hex)
+    amounts = redis_store.hgetall(ORDER_COUNT_FLUSHING_KEY)
+    flush_id = amounts.pop(FLUSH_ID_FIELD)
+
+    counts = dict((int(house_id), int(amount)) for house_id, amount in amounts.items() if int(amount))
+    if counts and OrderCountFlush.query.get(flush_id) is None:
+        try:
+            House.query.filter(House.id.in_(counts.keys()))\
+                .update({House.order_count: func.coalesce(House.order_count, 0) +
+                         case(counts, value=House.id, else_=0)}, synchronize_session=False)
+            db.session.add(OrderCountFlush(id=flush_id))
+            OrderCountFlush.query.filter(OrderCountFlush.create_time < datetime.now() - FLUSH_RECORD_KEEP)\
+                .delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    redis_store.delete(ORDER_COUNT_FLUSHING_KEY)
+    return len(counts)
+
+
+def reconcile_order_counts():
+    """
+    根据订单表中已完成的订单重新计算全部房屋的订单数
+    重新计算提交后清空缓冲的增量，避免重复累加。
+    重新计算可能减少订单数，而首页排行和订单数排序索引按只增不减增量维护，因此之后全部重建
+    :return: 更新的房屋数量，其他进程正在写入订单数时返回None
+    """
+    from ihome.models import House, Order
+    from ihome.utils import house_cache, house_index
+    lease = RedisLease('order_count_flush', constants.ORDER_COUNT_FLUSH_LEASE_EXPIRES)
+    if not lease.acquire():
+        return None
+    try:
+        completed = db.session.query(func.count(Order.id))\
+            .filter(Order.house_id == House.id, Order.status == 'COMPLETE').correlate(House).as_scalar()
+        try:
+            count = House.query.update({House.order_count: completed}, synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        # 重新计算提交后才清空缓冲的增量，重新计算期间的累加已计入订单表，不会在下次写入时重复累加
+        redis_store.delete(ORDER_COUNT_BUFFER_KEY, ORDER_COUNT_FLUSHING_KEY)
+    finally:
+        lease.release()
+
+    house_cache.rebuild_home_page_houses()
+    house_index.rebuild_house_index()
+    return count
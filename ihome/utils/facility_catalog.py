@@ -0,0 +1,79 @@
+# coding=utf-8
+"""
+房屋设施的进程内目录
+
+设施表是很少变化的参考数据。每个进程在内存中保存全部设施以及设施列表接口的响应数据，
+redis中只保存一个版本号，设施数据修改后调用request_refresh递增版本号，
+各进程在下次使用时比较版本号并重新加载
+"""
+
+import json
+
+from ihome import redis_store
+
+
+# 设施目录的版本号
+FACILITY_VERSION_KEY = 'facility_version'
+
+# 进程内的设施目录，字段：version, facilities(设施编号到名字的字典), body，更新时整体替换，读取时不需要加锁
+_catalog = {}
+
+
+def _load_catalog(version):
+    """从数据库中加载全部设施，构造进程内的设施目录"""
+    from ihome.models import Facility
+    facilities = Facility.query.order_by(Facility.id).all()
+    catalog = {
+        'version': version,
+        'facilities': dict((facility.id, facility.name) for facility in facilities),
+        'body': '{"errno":0,"errmsg":"OK","data":%s}' % json.dumps([facility.to_dict() for facility in facilities]),
+    }
+    global _catalog
+    _catalog = catalog
+    return catalog
+
+
+def get_catalog():
+    """
+    获取设施目录
+    1. 从redis中读取版本号，与进程内的目录一致时直接返回
+    2. 版本号变化或进程内没有目录时从数据库中重新加载
+    :return: 字典，字段为version, facilities, body
+    """
+    try:
+        version = redis_store.get(FACILITY_VERSION_KEY)
+        if version is None:
+            # 版本号不存在时初始化，其他进程已初始化时使用其版本号
+            redis_store.setnx(FACILITY_VERSION_KEY, 1)
+            version = redis_store.get(FACILITY_VERSION_KEY)
+    except Exception:
+        # redis不可用时，继续使用进程内已加载的目录
+        version = _catalog.get('version')
+
+    catalog = _catalog
+    if catalog and catalog.get('version') == version:
+        return catalog
+    return _load_catalog(version)
+
+
+def validate_facility_ids(facility_ids):
+    """
+    校验设施编号，去掉不存在的设施
+    :param facility_ids: 设施编号列表，元素可以为字符串
+    :return: 有效的设施编号列表，按编号排序
+    """
+    facilities = get_catalog()['facilities']
+    valid_ids = set()
+    for facility_id in facility_ids:
+        try:
+            facility_id = int(facility_id)
+        except (TypeError, ValueError):
+            continue
+        if facility_id in facilities:
+            valid_ids.add(facility_id)
+    return sorted(valid_ids)
+
+
+def request_refresh():
+    """设施数据修改后调用，各进程在下次使用时重新加载设施目录"""
+    redis_store.incr(FACILITY_VERSION_KEY)
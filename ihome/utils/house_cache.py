@@ -0,0 +1,196 @@
+# coding=utf-8
+"""
+房屋数据的redis缓存
+
+房屋列表：每组查询条件(城区, 入住日期, 离开日期, 排序方式)的每一页数据通过cache.get_or_compute缓存，
+键名中包含城区的版本号，房屋或订单数据变化时递增城区的版本号，旧版本的缓存不再被读取，过期后自动删除。
+查询前读取版本号，写入缓存时使用查询前的版本号，
+在数据变化前开始、变化后才写入的查询结果写入旧版本的键，不会被读取
+
+首页排行：有序集合中只保存订单数最多的前N个房屋，随订单完成和图片上传增量更新，
+排行变化后删除首页接口的响应缓存
+
+房屋详情：每个房屋的详情数据通过cache.get_or_compute缓存，相关数据提交到数据库后删除
+
+评论feed：每个房屋最新的评论保存在一个list中，订单完成评论时追加，详情页只需读取一次
+"""
+
+import json
+
+from ihome import redis_store, constants
+from ihome.utils import cache
+
+
+def _house_list_version_key(area_id):
+    """城区房屋列表缓存的版本号的键名，area_id为空时表示不限城区"""
+    return 'house_list_version_%s' % area_id
+
+
+def house_list_key(version, area_id, start_date, end_date, sort_key, page, facilities=''):
+    """房屋列表一页数据的缓存键名，facilities为筛选的设施编号字符串"""
+    key = 'cache_house_list_v%s_%s_%s_%s_%s_%s' % (version, area_id, start_date, end_date, sort_key, page)
+    if facilities:
+        key += '_%s' % facilities
+    return key
+
+
+def get_house_list_version(area_id):
+    """
+    获取城区房屋列表缓存的版本号
+    查询数据库前读取，使用该版本号构造house_list_key
+    """
+    return redis_store.get(_house_list_version_key(area_id)) or 0
+
+
+def invalidate_house_list(area_id):
+    """
+    递增城区的版本号，使城区的全部房屋列表缓存失效
+    不限城区的搜索结果中也包含该城区的房屋，需要一并失效
+    """
+    pipeline = redis_store.pipeline()
+    pipeline.incr(_house_list_version_key(area_id))
+    pipeline.incr(_house_list_version_key(''))
+    pipeline.execute()
+
+
+# 首页展示的房屋排行，有序集合，成员为房屋编号，分值为房屋的订单数，只保留前HOME_PAGE_MAX_HOUSES个
+HOME_PAGE_RANK_KEY = 'home_page_houses'
+# 首页排行已构建的标记
+HOME_PAGE_RANK_READY_KEY = 'home_page_houses_ready'
+# 首页房屋的基本信息，hash，字段为房屋编号，值为房屋基本信息的json数据
+HOME_PAGE_DATA_KEY = 'home_page_house_data'
+# 首页接口的响应缓存
+HOME_PAGE_CACHE_KEY = 'cache_house_index'
+
+
+def rebuild_home_page_houses():
+    """
+    从数据库中重新构建首页房屋排行
+    只在排行不存在时执行一次，之后通过update_home_page_house增量维护
+    :return: 排行中的房屋列表
+    """
+    from ihome.models import House
+    houses = House.query.filter(House.index_image_url != '')\
+        .order_by(House.order_count.desc()).limit(constants.HOME_PAGE_MAX_HOUSES).all()
+
+    pipeline = redis_store.pipeline()
+    pipeline.delete(HOME_PAGE_RANK_KEY, HOME_PAGE_DATA_KEY)
+    for house in houses:
+        pipeline.zadd(HOME_PAGE_RANK_KEY, house.order_count or 0, house.id)
+    pipeline.set(HOME_PAGE_RANK_READY_KEY, 1)
+    pipeline.execute()
+    cache.invalidate(HOME_PAGE_CACHE_KEY)
+    return houses
+
+
+def update_home_page_house(house, order_count=None):
+    """
+    房屋的订单数或主图片变化后，增量更新首页排行
+    订单数只增不减，排行外的房屋只有在自身订单数增加时才可能进入前N名，
+    因此将该房屋按最新订单数加入排行后，截掉排名在N之后的房屋即可
+    :param order_count: 房屋的最新订单数，为None时使用house.order_count
+    """
+    if not house.index_image_url or not redis_store.exists(HOME_PAGE_RANK_READY_KEY):
+        return
+    if order_count is None:
+        order_count = house.order_count or 0
+    pipeline = redis_store.pipeline()
+    pipeline.zadd(HOME_PAGE_RANK_KEY, order_count, house.id)
+    pipeline.zremrangebyrank(HOME_PAGE_RANK_KEY, 0, -(constants.HOME_PAGE_MAX_HOUSES + 1))
+    pipeline.hdel(HOME_PAGE_DATA_KEY, house.id)
+    pipeline.execute()
+    cache.invalidate(HOME_PAGE_CACHE_KEY)
+
+
+def get_home_page_house_ids():
+    """获取首页排行中的房屋编号，排行未构建时返回None"""
+    if not redis_store.exists(HOME_PAGE_RANK_READY_KEY):
+        return None
+    return [int(house_id) for house_id in
+            redis_store.zrevrange(HOME_PAGE_RANK_KEY, 0, constants.HOME_PAGE_MAX_HOUSES - 1)]
+
+
+def get_home_page_house_data(house_ids):
+    """批量获取首页房屋的基本信息json数据，没有缓存的房屋对应None"""
+    if not house_ids:
+        return []
+    return redis_store.hmget(HOME_PAGE_DATA_KEY, house_ids)
+
+
+def set_home_page_house_data(house_data):
+    """
+    缓存首页房屋的基本信息
+    :param house_data: 房屋编号到基本信息json数据的字典
+    """
+    if not house_data:
+        return
+    pipeline = redis_store.pipeline()
+    pipeline.hmset(HOME_PAGE_DATA_KEY, house_data)
+    pipeline.expire(HOME_PAGE_DATA_KEY, constants.HOME_PAGE_DATA_REDIS_EXPIRES)
+    pipeline.execute()
+
+
+def house_detail_key(house_id):
+    """房屋详情缓存的键名"""
+    return 'cache_house_info_%s' % house_id
+
+
+def invalidate_house_detail(house_id):
+    """房屋图片、评论或房屋信息变化后，删除房屋详情缓存"""
+    cache.invalidate(house_detail_key(house_id))
+
+
+# 已构建评论feed的房屋编号集合
+HOUSE_COMMENTS_READY_KEY = 'house_comments_ready'
+
+
+def _house_comments_key(house_id):
+    """房屋评论feed的键名，list，最新的评论在最前面"""
+    return 'house_comments_%s' % house_id
+
+
+def rebuild_house_comments(house_id):
+    """
+    从数据库中构建房屋的评论feed
+    :return: 评论字典列表
+    """
+    from ihome.models import Order, User, preload_many_to_one
+    orders = Order.query.filter(Order.house_id == house_id, Order.status == 'COMPLETE', Order.comment != None)\
+        .order_by(Order.update_time.desc()).limit(constants.HOUSE_DETAIL_COMMENT_DISPLAY_COUNTS).all()
+    preload_many_to_one(orders, 'user', User, 'user_id')
+    comments = [order.to_comment_dict() for order in orders]
+
+    key = _house_comments_key(house_id)
+    pipeline = redis_store.pipeline()
+    pipeline.delete(key)
+    if comments:
+        pipeline.rpush(key, *[json.dumps(comment) for comment in comments])
+    pipeline.sadd(HOUSE_COMMENTS_READY_KEY, house_id)
+    pipeline.execute()
+    return comments
+
+
+def get_house_comments(house_id):
+    """获取房屋的评论feed，feed尚未构建时从数据库构建"""
+    pipeline = redis_store.pipeline()
+    pipeline.sismember(HOUSE_COMMENTS_READY_KEY, house_id)
+    pipeline.lrange(_house_comments_key(house_id), 0, constants.HOUSE_DETAIL_COMMENT_DISPLAY_COUNTS - 1)
+    ready, comments = pipeline.execute()
+    if not ready:
+        return rebuild_house_comments(house_id)
+    return [json.loads(comment) for comment in comments]
+
+
+def push_house_comment(house_id, comment):
+    """
+    订单完成并评论后，将评论加入房屋的评论feed，只保留最新的HOUSE_DETAIL_COMMENT_DISPLAY_COUNTS条
+    feed尚未构建时不做处理，之后读取时会从数据库构建
+    :param comment: Order.to_comment_dict()返回的评论字典
+    """
+    if not redis_store.sismember(HOUSE_COMMENTS_READY_KEY, house_id):
+        return
+    key = _house_comments_key(house_id)
+    pipeline = redis_store.pipeline()
+    pipeline.lpush(key, json.dumps(comment))
+    pipeline.ltrim(key, 0, constants.HOUSE_DETAIL_COMMENT_DISPLAY_COUNTS - 1)
+    pipeline.execute()
@@ -0,0 +1,193 @@
+# coding=utf-8
+"""
+房屋的预订日历
+
+每个房屋在redis中保存一个位图，每一位对应一天，位为1表示当天已被有效订单占用。
+位的偏移量为日期与CALENDAR_EPOCH相差的天数。
+判断一段日期是否可以预订时，只需GETRANGE取出对应的字节并检查其中的位，
+不必在ih_order_info上做日期区间查询
+
+已有位图的房屋编号保存在一个集合中，全量重建时按集合删除位图，不扫描整个redis。
+日历不存在时，只有获得租约锁的进程从数据库构建，其他进程在构建完成前查询数据库。
+构建期间订单占用或释放的日期同时记入一个列表，构建写入位图后按顺序重放，
+避免构建时读取的旧数据覆盖这些变化
+"""
+
+from datetime import date, timedelta
+
+from flask import current_app
+
+from ihome import db, redis_store, constants
+from ihome.utils.interval_index import ACTIVE_ORDER_STATUS
+from ihome.utils.redis_lock import RedisLease
+
+
+# 位图中第0位对应的日期
+CALENDAR_EPOCH = date(2018, 1, 1)
+# 预订日历已构建的标记
+HOUSE_CALENDAR_READY_KEY = 'house_calendar_ready'
+# 已有预订日历位图的房屋编号集合
+HOUSE_CALENDAR_HOUSES_KEY = 'house_calendar_houses'
+# 构建期间订单占用或释放的日期，list，元素为"位的值:房屋编号:开始日期序数:结束日期序数"
+HOUSE_CALENDAR_CHANGES_KEY = 'house_calendar_changes'
+# 构建预订日历的租约锁名称
+HOUSE_CALENDAR_BUILD_LEASE = 'house_calendar_build'
+
+
+def _calendar_key(house_id):
+    """房屋预订日历的键名"""
+    return 'house_calendar_%s' % house_id
+
+
+def _as_date(value):
+    """将datetime转换为date"""
+    return value.date() if hasattr(value, 'date') else value
+
+
+def _offsets(begin_date, end_date):
+    """日期区间[begin_date, end_date]内每一天在位图中的偏移量，早于CALENDAR_EPOCH的日期被忽略"""
+    begin = max(_as_date(begin_date).toordinal(), CALENDAR_EPOCH.toordinal())
+    end = _as_date(end_date).toordinal()
+    return range(begin - CALENDAR_EPOCH.toordinal(), end - CALENDAR_EPOCH.toordinal() + 1)
+
+
+def _build_lease():
+    return RedisLease(HOUSE_CALENDAR_BUILD_LEASE, constants.HOUSE_CALENDAR_BUILD_LEASE_EXPIRES)
+
+
+def _set_days(pipeline, house_id, begin_date, end_date, value):
+    key = _calendar_key(house_id)
+    for offset in _offsets(begin_date, end_date):
+        pipeline.setbit(key, offset, value)
+    pipeline.sadd(HOUSE_CALENDAR_HOUSES_KEY, house_id)
+
+
+def _change_order_days(order, value):
+    """修改订单占用日期的位，预订日历正在构建时同时记录这次修改"""
+    pipeline = redis_store.pipeline()
+    _set_days(pipeline, order.house_id, order.begin_date, order.end_date, value)
+    if _build_lease().held():
+        pipeline.rpush(HOUSE_CALENDAR_CHANGES_KEY, '%d:%d:%d:%d' % (
+            value, order.house_id, _as_date(order.begin_date).toordinal(), _as_date(order.end_date).toordinal()))
+    pipeline.execute()
+
+
+def mark_order_days(order):
+    """订单生效或被接单后，将订单占用的日期标记为已预订"""
+    _change_order_days(order, 1)
+
+
+def release_order_days(order):
+    """订单被取消或拒单后，释放订单占用的日期"""
+    _change_order_days(order, 0)
+
+
+def _replay_changes():
+    """按顺序重放构建期间记录的修改"""
+    pipeline = redis_store.pipeline()
+    pipeline.lrange(HOUSE_CALENDAR_CHANGES_KEY, 0, -1)
+    pipeline.delete(HOUSE_CALENDAR_CHANGES_KEY)
+    changes = pipeline.execute()[0]
+    if not changes:
+        return
+    pipeline = redis_store.pipeline()
+    for change in changes:
+        value, house_id, begin, end = [int(item) for item in change.split(':')]
+        _set_days(pipeline, house_id, date.fromordinal(begin), date.fromordinal(end), value)
+    pipeline.execute()
+
+
+def rebuild_house_calendars(clear=True):
+    """
+    在租约锁保护下，从数据库中重新构建全部房屋的预订日历
+    只加载结束日期不早于今天的有效订单
+    :param clear: 是否先删除原有的位图，日历不存在时的构建不需要删除
+    :return: 加入日历的订单数量，其他进程正在构建时返回None
+    """
+    from ihome.models import Order
+    lease = _build_lease()
+    if not lease.acquire():
+        return None
+    try:
+        redis_store.delete(HOUSE_CALENDAR_CHANGES_KEY)
+        # 结束当前事务，构建时读取最新提交的订单，不使用事务开始时的快照
+        db.session.commit()
+        orders = Order.query.with_entities(Order.house_id, Order.begin_date, Order.end_date)\
+            .filter(Order.status.in_(ACTIVE_ORDER_STATUS), Order.end_date >= date.today()).all()
+
+        pipeline = redis_store.pipeline()
+        if clear:
+            house_ids = redis_store.smembers(HOUSE_CALENDAR_HOUSES_KEY)
+            pipeline.delete(HOUSE_CALENDAR_HOUSES_KEY, *[_calendar_key(house_id) for house_id in house_ids])
+        for order in orders:
+            _set_days(pipeline, order.house_id, order.begin_date, order.end_date, 1)
+        pipeline.set(HOUSE_CALENDAR_READY_KEY, 1)
+        pipeline.execute()
+        _replay_changes()
+    finally:
+        lease.release()
+    return len(orders)
+
+
+def _ensure_calendars():
+    """
+    预订日历不存在时构建
+    :return: 预订日历是否可用，其他进程正在构建时返回False
+    """
+    if redis_store.exists(HOUSE_CALENDAR_READY_KEY):
+        return True
+    current_app.logger.info('build house calendars')
+    return rebuild_house_calendars(clear=False) is not None
+
+
+def _query_booked_days(house_id, begin_date, end_date):
+    """预订日历正在构建时，从数据库查询房屋在[begin_date, end_date]内已被预订的日期"""
+    from ihome.models import Order
+    begin_date, end_date = _as_date(begin_date), _as_date(end_date)
+    orders = Order.query.with_entities(Order.begin_date, Order.end_date)\
+        .filter(Order.house_id == house_id, Order.status.in_(ACTIVE_ORDER_STATUS),
+                Order.begin_date <= end_date, Order.end_date >= begin_date).all()
+    booked_days = set()
+    for order in orders:
+        day = max(_as_date(order.begin_date), begin_date)
+        while day <= min(_as_date(order.end_date), end_date):
+            booked_days.add(day)
+            day += timedelta(days=1)
+    return sorted(booked_days)
+
+
+def _calendar_booked_days(house_id, begin_date, end_date):
+    """从位图中查询已被预订的日期"""
+    offsets = _offsets(begin_date, end_date)
+    if not offsets:
+        return []
+
+    # 一次取出区间覆盖的全部字节，超出位图长度的部分按未预订处理
+    first_byte = offsets[0] // 8
+    data = bytearray(redis_store.getrange(_calendar_key(house_id), first_byte, offsets[-1] // 8))
+    booked_days = []
+    for offset in offsets:
+        index = offset // 8 - first_byte
+        if index < len(data) and data[index] & (0x80 >> (offset % 8)):
+            booked_days.append(CALENDAR_EPOCH + timedelta(days=offset))
+    return booked_days
+
+
+def get_booked_days(house_id, begin_date, end_date):
+    """
+    查询房屋在[begin_date, end_date]内已被预订的日期
+    :return: 已被预订的date列表
+    """
+    if not _ensure_calendars():
+        return _query_booked_days(house_id, begin_date, end_date)
+    return _calendar_booked_days(house_id, begin_date, end_date)
+
+
+def is_available(house_id, begin_date, end_date):
+    """
+    判断房屋在[begin_date, end_date]内是否可以预订
+    预订日历正在构建时返回True，由下单时的加锁查询判断
+    """
+    if not _ensure_calendars():
+        return True
+    return not _calendar_booked_days(house_id, begin_date, end_date)
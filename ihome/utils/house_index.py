@@ -0,0 +1,242 @@
+# coding=utf-8
+"""
+房屋列表排序的redis索引
+
+每个城区为每种排序字段维护一个有序集合，成员为房屋编号，分值为排序字段的值，
+另有一组不区分城区的有序集合用于不限城区的搜索。
+按价格、发布时间、订单数排序分页时，只需ZRANGE取出当前页的房屋编号，
+再按编号批量查询一次数据库，不再需要MySQL的filesort
+
+每个设施维护一个集合，成员为拥有该设施的房屋编号。按设施筛选时，
+用ZINTERSTORE将排序索引与设施集合求交集，结果集合的分值仍为排序字段的值
+
+索引不存在时(首次部署、redis清空或重启后)，第一个搜索请求在租约锁保护下构建索引，
+构建期间其他请求退回到数据库排序查询，新增的房屋照常写入索引
+"""
+
+import time
+
+from flask import current_app
+
+from ihome import db, redis_store, constants
+from ihome.utils.redis_lock import RedisLease
+
+
+# 排序方式对应的(有序集合中的排序字段, 是否降序)
+SORT_FIELDS = {
+    'new': ('new', True),
+    'booking': ('booking', True),
+    'price-inc': ('price', False),
+    'price-des': ('price', True),
+}
+
+# 排序索引已构建的标记
+HOUSE_INDEX_READY_KEY = 'house_sort_ready'
+# 索引的版本号，索引内容变化时递增，设施筛选的交集结果以版本号区分
+HOUSE_INDEX_VERSION_KEY = 'house_sort_version'
+# 设施筛选交集结果的缓存时间，单位：秒
+FACILITY_FILTER_EXPIRES = 60
+# 构建索引的租约锁名称
+HOUSE_INDEX_BUILD_LEASE = 'house_sort_build'
+
+
+def _sort_key(field, area_id):
+    """排序索引的键名，area_id为空时表示不限城区"""
+    return 'house_sort_%s_%s' % (field, area_id or 'all')
+
+
+def _facility_key(facility_id):
+    """拥有某设施的房屋编号集合的键名"""
+    return 'facility_houses_%s' % facility_id
+
+
+def _scores(house):
+    """房屋在各个排序字段上的分值"""
+    return {
+        'price': house.price or 0,
+        'new': time.mktime(house.create_time.timetuple()),
+        'booking': house.order_count or 0,
+    }
+
+
+def _add_house(pipeline, house):
+    for field, score in _scores(house).items():
+        pipeline.zadd(_sort_key(field, house.area_id), score, house.id)
+        pipeline.zadd(_sort_key(field, None), score, house.id)
+
+
+def _build_lease():
+    return RedisLease(HOUSE_INDEX_BUILD_LEASE, constants.HOUSE_INDEX_BUILD_LEASE_EXPIRES)
+
+
+def _index_writable():
+    """索引已构建或正在构建时才需要写入，构建期间写入的房屋不会被构建遗漏"""
+    return redis_store.exists(HOUSE_INDEX_READY_KEY) or _build_lease().held()
+
+
+def index_house(house, facility_ids=None, old_facility_ids=()):
+    """
+    房屋新增或修改后，更新房屋在各排序索引中的分值以及所属的设施集合
+    :param facility_ids: 房屋的设施编号列表，为None时使用house.facilities
+    :param old_facility_ids: 修改房屋时房屋原来的设施编号，不再拥有的设施集合中会删除该房屋
+    """
+    if not _index_writable():
+        return
+    if facility_ids is None:
+        facility_ids = [facility.id for facility in house.facilities]
+    facility_ids = set(facility_ids)
+    pipeline = redis_store.pipeline()
+    _add_house(pipeline, house)
+    for facility_id in set(old_facility_ids) - facility_ids:
+        pipeline.srem(_facility_key(facility_id), house.id)
+    for facility_id in facility_ids:
+        pipeline.sadd(_facility_key(facility_id), house.id)
+    pipeline.incr(HOUSE_INDEX_VERSION_KEY)
+    pipeline.execute()
+
+
+def update_house_booking(house, order_count=None):
+    """
+    订单完成后，更新房屋在订单数排序索引中的分值
+    :param order_count: 房屋的最新订单数，为None时使用house.order_count
+    """
+    if not _index_writable():
+        return
+    if order_count is None:
+        order_count = house.order_count or 0
+    pipeline = redis_store.pipeline()
+    pipeline.zadd(_sort_key('booking', house.area_id), order_count, house.id)
+    pipeline.zadd(_sort_key('booking', None), order_count, house.id)
+    pipeline.incr(HOUSE_INDEX_VERSION_KEY)
+    pipeline.execute()
+
+
+def rebuild_house_index(clear=True):
+    """
+    从数据库中重新构建全部排序索引
+    :param clear: 是否先删除原有的索引。索引不存在时的构建不删除，
+                  以免删除构建期间其他请求写入的房屋
+    :return: 加入索引的房屋数量
+    """
+    from ihome.models import Area, Facility, House, house_facility
+    houses = House.query.with_entities(House.id, House.area_id, House.price,
+                                       House.create_time, House.order_count).all()
+    house_facilities = db.session.query(house_facility.c.house_id, house_facility.c.facility_id).all()
+
+    pipeline = redis_store.pipeline()
+    if clear:
+        area_ids = [area.id for area in Area.query.with_entities(Area.id).all()]
+        facility_ids = [facility.id for facility in Facility.query.with_entities(Facility.id).all()]
+        for field in ('price', 'new', 'booking'):
+            pipeline.delete(_sort_key(field, None), *[_sort_key(field, area_id) for area_id in area_ids])
+        if facility_ids:
+            pipeline.delete(*[_facility_key(facility_id) for facility_id in facility_ids])
+    for house in houses:
+        _add_house(pipeline, house)
+    for house_id, facility_id in house_facilities:
+        pipeline.sadd(_facility_key(facility_id), house_id)
+    pipeline.set(HOUSE_INDEX_READY_KEY, 1)
+    pipeline.incr(HOUSE_INDEX_VERSION_KEY)
+    pipeline.execute()
+    return len(houses)
+
+
+def ensure_house_index():
+    """
+    索引不存在时构建索引
+    只有获得租约锁的进程构建，其他进程不等待，由调用方退回到数据库查询
+    :return: 索引是否可用
+    """
+    if redis_store.exists(HOUSE_INDEX_READY_KEY):
+        return True
+    lease = _build_lease()
+    if not lease.acquire():
+        return False
+    try:
+        current_app.logger.info('build house sort index')
+        # 结束当前事务，构建时读取最新提交的房屋，不使用事务开始时的快照
+        db.session.commit()
+        rebuild_house_index(clear=False)
+    finally:
+        lease.release()
+    return True
+
+
+def _filter_by_facilities(key, facility_ids):
+    """
+    将排序索引与设施集合求交集，返回交集结果的键名
+    集合成员的分值按1计算，交集中保留排序索引的分值
+    """
+    version = redis_store.get(HOUSE_INDEX_VERSION_KEY) or 0
+    result_key = '%s_fac_%s_v%s' % (key, '_'.join(str(facility_id) for facility_id in facility_ids), version)
+    if not redis_store.exists(result_key):
+        weights = {key: 1}
+        for facility_id in facility_ids:
+            weights[_facility_key(facility_id)] = 0
+        pipeline = redis_store.pipeline()
+        pipeline.zinterstore(result_key, weights)
+        pipeline.expire(result_key, FACILITY_FILTER_EXPIRES)
+        pipeline.execute()
+    return result_key
+
+
+def get_facility_house_ids(facility_ids):
+    """
+    用SINTER求设施集合的交集，查询具备全部设施的房屋编号
+    :return: 房屋编号集合，索引正在由其他进程构建时返回None
+    """
+    if not ensure_house_index():
+        return None
+    return set(int(house_id) for house_id in
+               redis_store.sinter([_facility_key(facility_id) for facility_id in facility_ids]))
+
+
+def search_house_ids(area_id, sort_key, page, per_page, exclude_ids=None, facility_ids=None):
+    """
+    按排序索引查询一页房屋编号
+    :param area_id: 城区编号，为空时不限城区
+    :param sort_key: 排序方式，见SORT_FIELDS
+    :param page: 页码，从1开始
+    :param per_page: 每页的条目数
+    :param exclude_ids: 需要排除的房屋编号，如该时间段内已被预订的房屋
+    :param facility_ids: 房屋必须具备的设施编号列表
+    :return: (当前页的房屋编号列表, 符合条件的房屋总数)，索引正在由其他进程构建时返回None
+    """
+    if not ensure_house_index():
+        return None
+
+    field, descending = SORT_FIELDS.get(sort_key, SORT_FIELDS['new'])
+    key = _sort_key(field, area_id)
+    if facility_ids:
+        key = _filter_by_facilities(key, sorted(facility_ids))
+    exclude_ids = list(exclude_ids or [])
+
+    # 查询集合大小以及被排除的房屋在集合中的排名
+    pipeline = redis_store.pipeline()
+    pipeline.zcard(key)
+    for house_id in exclude_ids:
+        if descending:
+            pipeline.zrevrank(key, house_id)
+        else:
+            pipeline.zrank(key, house_id)
+    result = pipeline.execute()
+    excluded_ranks = sorted(rank for rank in result[1:] if rank is not None)
+    total = result[0] - len(excluded_ranks)
+
+    # 计算第(page-1)*per_page个未被排除的房屋在集合中的排名，跳过排在它之前的被排除房屋
+    start = (page - 1) * per_page
+    for rank in excluded_ranks:
+        if rank <= start:
+            start += 1
+        else:
+            break
+    # 当前页范围内最多还有len(excluded_ranks)个被排除的房屋，多取出这些条目后再过滤
+    stop = start + per_page + len(excluded_ranks) - 1
+    if descending:
+        members = redis_store.zrevrange(key, start, stop)
+    else:
+        members = redis_store.zrange(key, start, stop)
+
+    excluded = set(exclude_ids)
+    house_ids = [int(member) for member in members if int(member) not in excluded]
+    return house_ids[:per_page], total
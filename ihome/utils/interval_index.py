@@ -0,0 +1,114 @@
+# coding=utf-8
+"""
+订单占用日期的区间索引
+
+使用redis的有序集合保存有效订单的占用区间，分值为区间结束日期的序数，
+成员为"订单编号:房屋编号:开始日期序数:结束日期序数"。
+每个城区一个有序集合，另有一个不区分城区的集合用于不限城区的搜索，
+按城区搜索时只读取该城区的区间，读取量与该城区的订单数相关，与全站订单数无关。
+查询某个时间段内有冲突的房屋时，只需按分值取出结束日期不早于查询开始日期的区间，
+再过滤开始日期不晚于查询结束日期的区间即可，不必扫描ih_order_info中的历史订单
+"""
+
+from datetime import date
+
+from flask import current_app
+
+from ihome import redis_store
+
+
+# 按城区划分的区间索引已经构建完成的标记
+ORDER_INTERVAL_READY_KEY = 'order_intervals_area_ready'
+
+# 占用房屋日期的订单状态，已取消和已拒单的订单不占用日期
+ACTIVE_ORDER_STATUS = ('WAIT_ACCEPT', 'WAIT_PAYMENT', 'PAID', 'WAIT_COMMENT', 'COMPLETE')
+
+
+def _ordinal(value):
+    """将date/datetime转换为日期序数"""
+    if hasattr(value, 'date'):
+        value = value.date()
+    return value.toordinal()
+
+
+def _interval_key(area_id):
+    """区间索引的键名，area_id为空时表示不限城区"""
+    return 'order_intervals_%s' % (area_id or 'all')
+
+
+def _member(order):
+    """构造订单在区间索引中的成员名"""
+    return '%d:%d:%d:%d' % (order.id, order.house_id, _ordinal(order.begin_date), _ordinal(order.end_date))
+
+
+def add_order_interval(order, area_id):
+    """
+    将订单的占用区间加入索引，同时清理已经结束的区间
+    :param area_id: 订单房屋所属的城区编号
+    """
+    pipeline = redis_store.pipeline()
+    for key in (_interval_key(area_id), _interval_key(None)):
+        pipeline.zadd(key, _ordinal(order.end_date), _member(order))
+        pipeline.zremrangebyscore(key, '-inf', date.today().toordinal() - 1)
+    pipeline.execute()
+
+
+def remove_order_interval(order, area_id):
+    """
+    订单被取消或拒绝后，从索引中移除占用区间
+    :param area_id: 订单房屋所属的城区编号
+    """
+    pipeline = redis_store.pipeline()
+    pipeline.zrem(_interval_key(area_id), _member(order))
+    pipeline.zrem(_interval_key(None), _member(order))
+    pipeline.execute()
+
+
+def rebuild_order_intervals():
+    """
+    从数据库中重新构建区间索引
+    只加载结束日期不早于今天的有效订单
+    :return: 加入索引的订单数量
+    """
+    from ihome import db
+    from ihome.models import Area, House, Order
+    today = date.today()
+    orders = db.session.query(Order.id, Order.house_id, Order.begin_date, Order.end_date, House.area_id)\
+        .join(House, Order.house_id == House.id)\
+        .filter(Order.status.in_(ACTIVE_ORDER_STATUS), Order.end_date >= today).all()
+    area_ids = [area.id for area in Area.query.with_entities(Area.id).all()]
+
+    pipeline = redis_store.pipeline()
+    pipeline.delete(_interval_key(None), *[_interval_key(area_id) for area_id in area_ids])
+    for order in orders:
+        pipeline.zadd(_interval_key(order.area_id), _ordinal(order.end_date), _member(order))
+        pipeline.zadd(_interval_key(None), _ordinal(order.end_date), _member(order))
+    pipeline.set(ORDER_INTERVAL_READY_KEY, 1)
+    pipeline.execute()
+    return len(orders)
+
+
+def get_conflict_house_ids(start_date, end_date, area_id=None):
+    """
+    查询在[start_date, end_date]时间段内已被预订的房屋编号
+    :param start_date: 查询的开始日期，为None时表示不限制
+    :param end_date: 查询的结束日期，为None时表示不限制
+    :param area_id: 城区编号，为空时不限城区
+    :return: 有冲突的房屋编号集合
+    """
+    if start_date is None and end_date is None:
+        return set()
+
+    if not redis_store.exists(ORDER_INTERVAL_READY_KEY):
+        current_app.logger.info('rebuild order interval index')
+        rebuild_order_intervals()
+
+    start = _ordinal(start_date) if start_date else '-inf'
+    end = _ordinal(end_date) if end_date else None
+
+    house_ids = set()
+    for member in redis_store.zrangebyscore(_interval_key(area_id), start, '+inf'):
+        order_id, house_id, begin, _ = member.split(':')
+        if end is None or int(begin) <= end:
+            house_ids.add(int(house_id))
+    return house_ids
@@ -0,0 +1,26 @@
+# coding=utf-8
+"""
+用户订单列表的redis缓存
+
+房客和房东的订单列表分别通过cache.get_or_compute缓存，只使用redis，不使用进程内缓存，
+订单创建或状态变化后，同时删除下单用户和房东的订单列表缓存
+"""
+
+from ihome import redis_store
+
+
+def user_orders_key(role, user_id):
+    """用户订单列表缓存的键名，role为custom(房客)或landlord(房东)"""
+    return 'cache_user_orders_%s_%s' % (role, user_id)
+
+
+def invalidate_user_orders(custom_ids=(), landlord_ids=()):
+    """
+    订单创建或状态变化后，删除相关用户的订单列表缓存
+    :param custom_ids: 下单用户的编号
+    :param landlord_ids: 房东的用户编号
+    """
+    keys = [user_orders_key('custom', user_id) for user_id in set(custom_ids)] + \
+           [user_orders_key('landlord', user_id) for user_id in set(landlord_ids)]
+    if keys:
+        redis_store.delete(*keys)
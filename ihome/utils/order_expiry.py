@@ -0,0 +1,98 @@
+# coding=utf-8
+"""
+过期订单的批量取消
+
+长时间未接单或未支付的订单会一直占用房屋的日期，定时任务(manage.py expire_orders)
+按状态索引分批取出过期的订单，每批用一条UPDATE语句取消，并释放订单占用的日期。
+多个进程同时执行时，只有获得租约锁的进程会处理
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from ihome import db, constants
+from ihome.models import House, Order
+from ihome.utils import house_cache, house_calendar, interval_index, order_cache
+from ihome.utils.redis_lock import RedisLease
+
+
+def _expire_chunk(status, cutoff, chunk_size):
+    """
+    取消一批过期订单
+    :return: 本批取消的订单数量
+    """
+    # 只锁定订单行，不锁定房屋行，下单请求对房屋加的行锁不会被整批订单阻塞
+    rows = db.session.query(Order.id, Order.user_id, Order.house_id, Order.begin_date, Order.end_date)\
+        .filter(Order.status == status, Order.update_time < cutoff)\
+        .order_by(Order.id).limit(chunk_size).with_for_update().all()
+    if not rows:
+        db.session.rollback()
+        return 0
+    # 房屋的城区和房东不会变化，不加锁读取
+    houses = dict((house.id, house) for house in
+                  db.session.query(House.id, House.user_id, House.area_id)
+                  .filter(House.id.in_(set(order.house_id for order in rows))).all())
+
+    try:
+        Order.query.filter(Order.id.in_([order.id for order in rows]), Order.status == status)\
+            .update({'status': 'CANCELED'}, synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    # 释放订单占用的日期，删除相关的缓存
+    try:
+        for order in rows:
+            interval_index.remove_order_interval(order, houses[order.house_id].area_id)
+            house_calendar.release_order_days(order)
+        for area_id in set(house.area_id for house in houses.values()):
+            house_cache.invalidate_house_list(area_id)
+        order_cache.invalidate_user_orders(custom_ids=[order.user_id for order in rows],
+                                           landlord_ids=[house.user_id for house in houses.values()])
+    except Exception as e:
+        current_app.logger.error(e)
+    return len(rows)
+
+
+def expire_stale_orders(max_ages=None, chunk_size=constants.ORDER_EXPIRY_CHUNK_SIZE):
+    """
+    分批取消过期的订单
+    :param max_ages: 订单状态到过期时间(秒)的字典，默认取constants中的配置
+    :param chunk_size: 每批处理的订单数量
+    :return: 每批的处理结果列表，元素为(订单状态, 取消的订单数量, 耗时秒数)；
+             其他进程正在处理时返回None
+    """
+    if max_ages is None:
+        max_ages = {
+            'WAIT_ACCEPT': constants.ORDER_WAIT_ACCEPT_EXPIRES,
+            'WAIT_PAYMENT': constants.ORDER_WAIT_PAYMENT_EXPIRES,
+        }
+
+    lease = RedisLease('order_expiry', constants.ORDER_EXPIRY_LEASE_EXPIRES)
+    if not lease.acquire():
+        return None
+
+    chunks = []
+    try:
+        for status, max_age in max_ages.items():
+            cutoff = datetime.now() - timedelta(seconds=max_age)
+            while True:
+                start = time.time()
+                count = _expire_chunk(status, cutoff, chunk_size)
+                if not count:
+                    break
+                elapsed = time.time() - start
+                chunks.append((status, count, elapsed))
+                current_app.logger.info('expired %d %s orders in %.3fs' % (count, status, elapsed))
+                if count < chunk_size:
+                    break
+                # 每处理完一批延长租约，租约已失效时停止处理
+                if not lease.renew():
+                    current_app.logger.warning('order expiry lease lost')
+                    return chunks
+    finally:
+        lease.release()
+    return chunks
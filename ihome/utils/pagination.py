@@ -0,0 +1,74 @@
+# coding=utf-8
+"""
+基于游标(keyset)的分页工具
+
+游标中保存上一页最后一条记录的排序字段值和主键，下一页的查询条件为
+(排序字段, 主键) 严格位于该记录之后，配合(排序字段, 主键)上的联合索引，
+任意页的查询代价都相同，不会随OFFSET增大而变慢
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+
+_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def encode_cursor(value, row_id):
+    """将排序字段值和主键编码为不透明的游标字符串"""
+    if isinstance(value, datetime):
+        data = ['t', value.strftime(_DATETIME_FORMAT), row_id]
+    else:
+        data = ['v', value, row_id]
+    return base64.urlsafe_b64encode(json.dumps(data))
+
+
+def decode_cursor(cursor):
+    """
+    解析游标字符串
+    :return: (排序字段值, 主键)
+    :raise ValueError: 游标格式错误
+    """
+    try:
+        kind, value, row_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if kind == 't':
+            value = datetime.strptime(value, _DATETIME_FORMAT)
+        return value, int(row_id)
+    except Exception:
+        raise ValueError('invalid cursor: %s' % cursor)
+
+
+def keyset_page(query, sort_column, id_column, descending, cursor, per_page):
+    """
+    按游标查询一页数据
+    :param query: 已添加过滤条件的查询对象
+    :param sort_column: 排序字段
+    :param id_column: 主键字段，用于排序字段值相同时确定顺序
+    :param descending: 是否降序
+    :param cursor: 上一页返回的游标，为空时查询第一页
+    :param per_page: 每页的条目数
+    :return: (当前页的数据列表, 下一页的游标，没有下一页时为None)
+    """
+    if cursor:
+        value, row_id = decode_cursor(cursor)
+        if descending:
+            query = query.filter(or_(sort_column < value, and_(sort_column == value, id_column < row_id)))
+        else:
+            query = query.filter(or_(sort_column > value, and_(sort_column == value, id_column > row_id)))
+
+    if descending:
+        query = query.order_by(sort_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(sort_column.asc(), id_column.asc())
+
+    # 多查询一条记录，用于判断是否还有下一页
+    items = query.limit(per_page + 1).all()
+    if len(items) <= per_page:
+        return items, None
+
+    items = items[:per_page]
+    last = items[-1]
+    return items, encode_cursor(getattr(last, sort_column.key), getattr(last, id_column.key))
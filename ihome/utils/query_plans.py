@@ -0,0 +1,70 @@
+# coding=utf-8
+"""
+热点查询的执行计划检查
+
+对房屋详情评论、用户订单列表、房屋列表等热点查询执行EXPLAIN，
+任何一张表的访问方式为ALL(全表扫描)或index(全索引扫描)时视为不通过，
+需要按索引顺序读取的排序查询使用filesort时也视为不通过，
+用于在修改模型或迁移索引后确认查询仍然使用索引(manage.py check_query_plans)
+"""
+
+from ihome import db, constants
+from ihome.models import House, Order
+
+
+def hot_queries():
+    """
+    需要检查的热点查询
+    房东的订单列表按订单的创建时间排序，但筛选条件在房屋表上，无法按索引顺序读取，允许filesort
+    :return: (查询名称, 查询对象, 是否禁止filesort)列表
+    """
+    return [
+        ('house comments', Order.query.filter(Order.house_id == 1, Order.status == 'COMPLETE', Order.comment != None)
+            .order_by(Order.update_time.desc()).limit(constants.HOUSE_DETAIL_COMMENT_DISPLAY_COUNTS), True),
+        ('custom orders', Order.query.filter(Order.user_id == 1).order_by(Order.create_time.desc()), True),
+        ('landlord orders', Order.query.join(House, Order.house_id == House.id)
+            .filter(House.user_id == 1).order_by(Order.create_time.desc()), False),
+        ('house list by price', House.query.filter(House.area_id == 1)
+            .order_by(House.price.asc(), House.id.asc()).limit(constants.HOUSE_LIST_PAGE_CAPACITY), True),
+        ('house list by time', House.query.filter(House.area_id == 1)
+            .order_by(House.create_time.desc(), House.id.desc()).limit(constants.HOUSE_LIST_PAGE_CAPACITY), True),
+        ('house list by order count', House.query.filter(House.area_id == 1)
+            .order_by(House.order_count.desc(), House.id.desc()).limit(constants.HOUSE_LIST_PAGE_CAPACITY), True),
+    ]
+
+
+def explain(query):
+    """
+    对查询执行EXPLAIN
+    :return: 执行计划的行列表，每行为一个字典
+    """
+    sql = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+    result = db.session.execute('EXPLAIN %s' % sql)
+    return [dict(zip(result.keys(), row)) for row in result]
+
+
+def plan_problems(plan, no_filesort):
+    """
+    执行计划中的问题
+    :param no_filesort: 是否禁止filesort
+    :return: 问题描述列表，没有问题时为空列表
+    """
+    problems = []
+    for row in plan:
+        if row.get('type') in ('ALL', 'index'):
+            problems.append('%s: type=%s' % (row.get('table'), row.get('type')))
+        if no_filesort and 'filesort' in (row.get('Extra') or ''):
+            problems.append('%s: Using filesort' % row.get('table'))
+    return problems
+
+
+def check_query_plans():
+    """
+    检查全部热点查询的执行计划
+    :return: (查询名称, 执行计划, 问题描述列表)列表，问题描述列表为空表示通过
+    """
+    results = []
+    for name, query, no_filesort in hot_queries():
+        plan = explain(query)
+        results.append((name, plan, plan_problems(plan, no_filesort)))
+    return results
@@ -0,0 +1,67 @@
+# coding=utf-8
+"""
+基于redis的租约锁
+
+锁的值为持有者的随机令牌，并设置过期时间，持有者崩溃后锁会自动释放。
+续租和释放时通过lua脚本校验令牌，避免误操作已被其他进程重新获得的锁
+"""
+
+import uuid
+
+from ihome import redis_store
+
+
+# 令牌一致时才延长过期时间
+_RENEW_SCRIPT = redis_store.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+# 令牌一致时才删除锁
+_RELEASE_SCRIPT = redis_store.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+
+class RedisLease(object):
+    """
+    租约锁
+    用法：
+        lease = RedisLease('order_expiry_leader', 60)
+        if lease.acquire():
+            try:
+                ...
+                lease.renew()
+            finally:
+                lease.release()
+    """
+
+    def __init__(self, name, ttl):
+        """
+        :param name: 锁的名称
+        :param ttl: 租约时长，单位：秒
+        """
+        self.key = 'lease_%s' % name
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+
+    def acquire(self):
+        """尝试获得锁，已被其他进程持有时返回False"""
+        return bool(redis_store.set(self.key, self.token, px=int(self.ttl * 1000), nx=True))
+
+    def renew(self):
+        """延长租约，锁已失效或被其他进程持有时返回False"""
+        return bool(_RENEW_SCRIPT(keys=[self.key], args=[self.token, int(self.ttl * 1000)]))
+
+    def held(self):
+        """锁是否被某个进程持有"""
+        return bool(redis_store.exists(self.key))
+
+    def release(self):
+        """释放锁"""
+        return bool(_RELEASE_SCRIPT(keys=[self.key], args=[self.token]))
@@ -0,0 +1,173 @@
+# coding=utf-8
+"""
+房屋标题和地址的进程内全文索引
+
+中文按相邻两个字切分为二元词(同时索引单字，以支持单字查询)，
+英文和数字按连续的字母数字切分为小写单词。倒排表保存每个词对应的房屋编号集合，
+关键词查询为查询词倒排表的交集，全部在内存中完成，不需要对ih_house_info做LIKE全表扫描。
+
+各个进程各自持有一份索引，通过redis同步房屋的修改：
+房屋写入后将房屋编号按递增的版本号加入有序集合，进程查询前比较版本号，
+只重新加载版本号变化后被修改过的房屋
+"""
+
+import re
+import threading
+
+from flask import current_app
+
+from ihome import redis_store
+
+
+# 索引版本号，房屋写入时递增
+HOUSE_TEXT_VERSION_KEY = 'house_text_version'
+# 被修改过的房屋，有序集合，成员为房屋编号，分值为修改时的版本号
+HOUSE_TEXT_CHANGES_KEY = 'house_text_changes'
+# 全量重建的代数，递增后各进程在下次查询时重新构建索引
+HOUSE_TEXT_GENERATION_KEY = 'house_text_generation'
+# 保留的房屋修改记录数量，落后更多版本的进程直接全量重建
+HOUSE_TEXT_CHANGES_MAX = 10000
+
+# 递增版本号并记录被修改的房屋，在一个脚本中原子执行，
+# 避免其他进程读到新版本号时还没有对应的修改记录
+_NOTIFY_SCRIPT = redis_store.register_script("""
+local version = redis.call('incr', KEYS[1])
+redis.call('zadd', KEYS[2], version, ARGV[1])
+redis.call('zremrangebyrank', KEYS[2], 0, -(tonumber(ARGV[2]) + 1))
+return version
+""")
+
+_TOKEN_RE = re.compile(u'([\u4e00-\u9fff]+)|([0-9a-zA-Z]+)')
+
+
+def tokenize(text, for_query=False):
+    """
+    将文本切分为词
+    :param text: 待切分的文本
+    :param for_query: 是否为查询词，查询时两个字以上的中文只使用二元词
+    :return: 词的集合
+    """
+    if not text:
+        return set()
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    tokens = set()
+    for chinese, word in _TOKEN_RE.findall(text):
+        if word:
+            tokens.add(word.lower())
+            continue
+        if len(chinese) == 1 or not for_query:
+            tokens.update(chinese)
+        for i in range(len(chinese) - 1):
+            tokens.add(chinese[i:i + 2])
+    return tokens
+
+
+class HouseTextIndex(object):
+    """房屋标题和地址的倒排索引"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._house_tokens = {}
+        self._version = None
+        self._generation = None
+
+    def _add(self, house_id, title, address):
+        self._remove(house_id)
+        tokens = tokenize(title) | tokenize(address)
+        self._house_tokens[house_id] = tokens
+        for token in tokens:
+            self._postings.setdefault(token, set()).add(house_id)
+
+    def _remove(self, house_id):
+        for token in self._house_tokens.pop(house_id, ()):
+            house_ids = self._postings.get(token)
+            if house_ids is not None:
+                house_ids.discard(house_id)
+                if not house_ids:
+                    del self._postings[token]
+
+    def build(self):
+        """
+        从数据库中全量构建索引
+        :return: 索引的房屋数量
+        """
+        from ihome.models import House
+        version = redis_store.get(HOUSE_TEXT_VERSION_KEY) or 0
+        generation = redis_store.get(HOUSE_TEXT_GENERATION_KEY) or 0
+        houses = House.query.with_entities(House.id, House.title, House.address).all()
+        with self._lock:
+            self._postings = {}
+            self._house_tokens = {}
+            for house in houses:
+                self._add(house.id, house.title, house.address)
+            self._version = int(version)
+            self._generation = int(generation)
+        return len(houses)
+
+    def sync(self):
+        """与redis中的版本号比较，重新加载其他进程修改过的房屋"""
+        pipeline = redis_store.pipeline()
+        pipeline.get(HOUSE_TEXT_VERSION_KEY)
+        pipeline.get(HOUSE_TEXT_GENERATION_KEY)
+        version, generation = pipeline.execute()
+        version, generation = int(version or 0), int(generation or 0)
+
+        if self._version is None or generation != self._generation \
+                or version - self._version > HOUSE_TEXT_CHANGES_MAX:
+            current_app.logger.info('build house text index')
+            self.build()
+            return
+        if version == self._version:
+            return
+
+        from ihome.models import House
+        house_ids = [int(house_id) for house_id in
+                     redis_store.zrangebyscore(HOUSE_TEXT_CHANGES_KEY, '(%d' % self._version, version)]
+        houses = House.query.with_entities(House.id, House.title, House.address)\
+            .filter(House.id.in_(house_ids)).all() if house_ids else []
+        with self._lock:
+            found = set()
+            for house in houses:
+                self._add(house.id, house.title, house.address)
+                found.add(house.id)
+            for house_id in set(house_ids) - found:
+                self._remove(house_id)
+            self._version = version
+
+    def search(self, keyword):
+        """
+        查询标题或地址包含关键词的房屋
+        :return: 房屋编号集合
+        """
+        tokens = tokenize(keyword, for_query=True)
+        if not tokens:
+            return set()
+        with self._lock:
+            postings = [self._postings.get(token, set()) for token in tokens]
+            postings.sort(key=len)
+            return set(postings[0]).intersection(*postings[1:])
+
+
+house_text_index = HouseTextIndex()
+
+
+def notify_house_changed(house_id):
+    """房屋写入数据库后调用，记录被修改的房屋，各进程在下次查询时增量更新索引"""
+    _NOTIFY_SCRIPT(keys=[HOUSE_TEXT_VERSION_KEY, HOUSE_TEXT_CHANGES_KEY],
+                   args=[house_id, HOUSE_TEXT_CHANGES_MAX])
+
+
+def request_rebuild():
+    """通知各进程在下次查询时全量重建索引，同时清理已记录的房屋修改"""
+    pipeline = redis_store.pipeline()
+    pipeline.delete(HOUSE_TEXT_CHANGES_KEY)
+    pipeline.incr(HOUSE_TEXT_GENERATION_KEY)
+    pipeline.execute()
+
+
+def search_houses(keyword):
+    """同步索引后查询关键词，返回房屋编号集合"""
+    house_text_index.sync()
+    return house_text_index.search(keyword)
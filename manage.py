@@ -12,6 +12,135 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def rebuild_order_intervals():
+    """根据订单表重新构建订单占用日期的区间索引"""
+    from ihome.utils.interval_index import rebuild_order_intervals
+    count = rebuild_order_intervals()
+    print 'order intervals rebuilt: %d' % count
+
+
+@manager.command
+def rebuild_house_index():
+    """根据房屋表重新构建房屋列表的排序索引，索引不存在时第一个搜索请求会自动构建，本命令用于清理后全量重建"""
+    from ihome.utils.house_index import rebuild_house_index
+    count = rebuild_house_index()
+    print 'house index rebuilt: %d' % count
+
+
+@manager.command
+def rebuild_house_calendars():
+    """根据订单表重新构建房屋的预订日历位图"""
+    from ihome.utils.house_calendar import rebuild_house_calendars
+    count = rebuild_house_calendars()
+    if count is None:
+        print 'house calendars are being rebuilt in another worker'
+    else:
+        print 'house calendars rebuilt: %d' % count
+
+
+@manager.command
+def rebuild_house_text_index():
+    """重新构建房屋的全文索引，并通知各个进程在下次查询时全量重建"""
+    import time
+    from ihome.utils import text_index
+    text_index.request_rebuild()
+    start = time.time()
+    count = text_index.house_text_index.build()
+    print 'house text index rebuilt: %d houses in %.3fs' % (count, time.time() - start)
+
+
+@manager.command
+def refresh_facilities():
+    """设施表修改后执行，通知各个进程在下次使用时重新加载设施目录"""
+    from ihome.utils import facility_catalog
+    facility_catalog.request_refresh()
+    print 'facility catalog version: %s' % facility_catalog.get_catalog()['version']
+
+
+@manager.option('-r', '--reconcile', dest='reconcile', action='store_true', default=False,
+                help='根据订单表重新计算全部房屋的订单数')
+def flush_order_counts(reconcile):
+    """将redis中累加的房屋订单数批量写入数据库，由定时任务周期执行"""
+    from ihome.utils import counters
+    if reconcile:
+        count = counters.reconcile_order_counts()
+    else:
+        count = counters.flush_order_counts()
+    if count is None:
+        print 'order counts are being flushed in another worker'
+    elif reconcile:
+        print 'order counts reconciled: %d houses' % count
+    else:
+        print 'order counts flushed: %d houses' % count
+
+
+@manager.option('-a', '--accept-age', dest='accept_age', type=int, default=None,
+                help='待接单订单的过期时间，单位：秒')
+@manager.option('-p', '--payment-age', dest='payment_age', type=int, default=None,
+                help='待支付订单的过期时间，单位：秒')
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int, default=None,
+                help='每批处理的订单数量')
+def expire_orders(accept_age, payment_age, chunk_size):
+    """分批取消长时间未接单或未支付的订单，由定时任务周期执行"""
+    from ihome import constants
+    from ihome.utils.order_expiry import expire_stale_orders
+    max_ages = {
+        'WAIT_ACCEPT': accept_age or constants.ORDER_WAIT_ACCEPT_EXPIRES,
+        'WAIT_PAYMENT': payment_age or constants.ORDER_WAIT_PAYMENT_EXPIRES,
+    }
+    chunks = expire_stale_orders(max_ages, chunk_size or constants.ORDER_EXPIRY_CHUNK_SIZE)
+    if chunks is None:
+        print 'order expiry is running in another worker'
+        return
+    for status, count, elapsed in chunks:
+        print '%s: %d orders in %.3fs' % (status, count, elapsed)
+    print 'orders expired: %d' % sum(count for _, count, _ in chunks)
+
+
+@manager.command
+def check_query_plans():
+    """对热点查询执行EXPLAIN，有查询使用全表扫描、全索引扫描或不应有的filesort时以非0状态退出"""
+    import sys
+    from ihome.utils.query_plans import check_query_plans
+    failed = False
+    for name, plan, problems in check_query_plans():
+        print '%s %s' % ('FAIL' if problems else 'OK  ', name)
+        for row in plan:
+            print '    table=%s type=%s key=%s rows=%s extra=%s' % (row.get('table'), row.get('type'), row.get('key'),
+                                                                 row.get('rows'), row.get('Extra'))
+        for problem in problems:
+            print '    %s' % problem
+        failed = failed or bool(problems)
+    if failed:
+        sys.exit(1)
+
+
+@manager.option('-n', '--size', dest='size', type=int, default=None, help='验证码池的目标数量')
+@manager.option('-l', '--loop', dest='loop', action='store_true', default=False,
+                help='持续运行，周期性地补充验证码池')
+def fill_captcha_pool(size, loop):
+    """预先生成图片验证码，补充redis中的验证码池"""
+    import time
+    from ihome import constants
+    from ihome.utils.captcha_pool import fill_pool
+    while True:
+        count = fill_pool(size)
+        if count:
+            print 'captchas produced: %d' % count
+        if not loop:
+            break
+        time.sleep(constants.CAPTCHA_POOL_REFILL_INTERVAL)
+
+
+@manager.command
+def captcha_pool_stats():
+    """输出验证码池的当前数量、生成速率和命中情况"""
+    from ihome.utils.captcha_pool import pool_stats
+    for name, value in sorted(pool_stats().items()):
+        print '%s: %s' % (name, value)
+
+
 if __name__ == '__main__':
     print app.url_map
     manager.run()
@@ -0,0 +1,78 @@
+# coding=utf-8
+"""并发预订同一房屋时，不会保存日期重叠的有效订单"""
+
+import json
+import random
+import threading
+import Queue
+from datetime import date, timedelta
+
+from ihome import db
+from ihome.models import Order
+from ihome.response_code import RET
+from ihome.utils.interval_index import ACTIVE_ORDER_STATUS
+from tests import IhomeTestCase
+
+
+class CreateOrderConcurrencyTest(IhomeTestCase):
+
+    # 预订请求的总数和并发的线程数
+    BOOKINGS = 300
+    THREADS = 30
+    # 预订日期的范围，范围越小重叠越多
+    DAYS = 20
+
+    def test_parallel_overlapping_bookings(self):
+        landlord = self.create_user('landlord')
+        house = self.create_house(landlord, self.create_area())
+        house_id = house.id
+        tenant_ids = [self.create_user('tenant%d' % i).id for i in range(self.THREADS)]
+
+        first_day = date.today() + timedelta(days=30)
+        jobs = Queue.Queue()
+        for i in range(self.BOOKINGS):
+            begin = first_day + timedelta(days=random.randint(0, self.DAYS - 1))
+            end = begin + timedelta(days=random.randint(0, 3))
+            jobs.put((begin.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+
+        start = threading.Event()
+        results = []
+        errors = []
+
+        def book(tenant_id):
+            client = self.app.test_client()
+            self.login(client, tenant_id)
+            start.wait()
+            while True:
+                try:
+                    begin, end = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    response = client.post('/api/v1.0/orders', content_type='application/json',
+                                           data=json.dumps({'house_id': house_id, 'start_date': begin,
+                                                            'end_date': end}))
+                    results.append(json.loads(response.data)['errno'])
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=book, args=(tenant_id,)) for tenant_id in tenant_ids]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), self.BOOKINGS)
+        # 冲突的请求只能因为日期已被预订而失败
+        self.assertEqual(set(results) - {RET.OK, RET.DATAERR}, set())
+
+        db.session.remove()
+        orders = Order.query.filter(Order.house_id == house_id, Order.status.in_(ACTIVE_ORDER_STATUS))\
+            .order_by(Order.begin_date).all()
+        self.assertTrue(orders)
+        self.assertEqual(len(orders), results.count(RET.OK))
+        for previous, current in zip(orders, orders[1:]):
+            self.assertLess(previous.end_date, current.begin_date,
+                            'orders %d and %d overlap' % (previous.id, current.id))
@@ -0,0 +1,71 @@
+# coding=utf-8
+"""房屋列表和订单列表的sql语句数量不随结果条数增加"""
+
+import json
+from datetime import datetime, timedelta
+
+from ihome import db, constants
+from ihome.models import Order
+from ihome.response_code import RET
+from tests import IhomeTestCase
+
+
+class QueryCountTest(IhomeTestCase):
+
+    def setUp(self):
+        super(QueryCountTest, self).setUp()
+        self.area = self.create_area()
+        self.landlord = self.create_user('landlord')
+        self.tenant = self.create_user('tenant')
+        self.area_id, self.landlord_id, self.tenant_id = self.area.id, self.landlord.id, self.tenant.id
+        self.houses = 0
+
+    def add_houses(self, number):
+        """新增房屋，每个房屋有一个租客的订单"""
+        begin = datetime.now() + timedelta(days=30)
+        for i in range(number):
+            self.houses += 1
+            house = self.create_house(self.landlord, self.area, title=u'房屋%d' % self.houses,
+                                      index_image_url='house%d.jpg' % self.houses)
+            db.session.add(Order(user_id=self.tenant_id, house_id=house.id, begin_date=begin,
+                                 end_date=begin, days=1, house_price=house.price, amount=house.price))
+        db.session.commit()
+        db.session.remove()
+        # 清空redis中的索引和缓存，之后的请求重新从数据库加载
+        self.flush_redis()
+
+    def house_list_queries(self):
+        # 第一次请求构建redis中的索引，不计入统计
+        self.client.get('/api/v1.0/houses?aid=%d&sk=price-inc' % self.area_id)
+        with self.count_queries() as statements:
+            response = self.client.get('/api/v1.0/houses?aid=%d&sk=new' % self.area_id)
+        data = json.loads(response.data)
+        self.assertEqual(data['errno'], RET.OK)
+        self.assertEqual(len(data['data']['houses']), min(self.houses, constants.HOUSE_LIST_PAGE_CAPACITY))
+        return statements
+
+    def user_orders_queries(self, role):
+        self.login(self.client, self.tenant_id if role == 'custom' else self.landlord_id)
+        with self.count_queries() as statements:
+            response = self.client.get('/api/v1.0/user/orders?role=%s' % role)
+        data = json.loads(response.data)
+        self.assertEqual(data['errno'], RET.OK)
+        self.assertEqual(len(data['data']['orders']), self.houses)
+        return statements
+
+    def test_house_list(self):
+        self.add_houses(2)
+        few = self.house_list_queries()
+        self.add_houses(8)
+        many = self.house_list_queries()
+        self.assertEqual(len(few), len(many), many)
+
+    def test_user_orders(self):
+        self.add_houses(1)
+        few = [self.user_orders_queries(role) for role in ('custom', 'landlord')]
+        self.add_houses(9)
+        many = [self.user_orders_queries(role) for role in ('custom', 'landlord')]
+        for few_statements, many_statements in zip(few, many):
+            # 订单与房屋信息通过一次联表查询取出
+            self.assertEqual(len(many_statements), 1, many_statements)
+            self.assertEqual(len(few_statements), len(many_statements))
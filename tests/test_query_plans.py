@@ -0,0 +1,46 @@
+# coding=utf-8
+"""热点查询在有一定数据量的表上使用索引，排序查询不使用filesort"""
+
+import random
+from datetime import datetime, timedelta
+
+from ihome import db
+from ihome.models import Area, House, Order, User
+from ihome.utils.query_plans import check_query_plans
+from tests import IhomeTestCase
+
+
+class QueryPlanTest(IhomeTestCase):
+
+    AREAS = 10
+    USERS = 50
+    HOUSES = 1000
+    ORDERS = 5000
+
+    def seed(self):
+        """批量写入测试数据，数据量足以让优化器选择索引"""
+        now = datetime.now()
+        db.session.execute(Area.__table__.insert(), [{'name': 'area%d' % i} for i in range(self.AREAS)])
+        db.session.execute(User.__table__.insert(), [
+            {'name': 'user%d' % i, 'mobile': str(13100000000 + i), 'password_hash': 'x'}
+            for i in range(self.USERS)])
+        db.session.execute(House.__table__.insert(), [
+            {'user_id': random.randint(1, self.USERS), 'area_id': random.randint(1, self.AREAS),
+             'title': 'house%d' % i, 'price': random.randint(100, 100000),
+             'order_count': random.randint(0, 100), 'create_time': now - timedelta(minutes=i)}
+            for i in range(self.HOUSES)])
+        statuses = ['WAIT_ACCEPT', 'WAIT_PAYMENT', 'PAID', 'WAIT_COMMENT', 'COMPLETE', 'CANCELED', 'REJECTED']
+        db.session.execute(Order.__table__.insert(), [
+            {'user_id': random.randint(1, self.USERS), 'house_id': random.randint(1, self.HOUSES),
+             'begin_date': now, 'end_date': now, 'days': 1, 'house_price': 100, 'amount': 100,
+             'status': random.choice(statuses), 'comment': 'comment',
+             'create_time': now - timedelta(minutes=i), 'update_time': now - timedelta(minutes=i)}
+            for i in range(self.ORDERS)])
+        db.session.commit()
+        for table in (Area.__table__, User.__table__, House.__table__, Order.__table__):
+            db.session.execute('ANALYZE TABLE %s' % table.name)
+
+    def test_hot_queries_use_indexes(self):
+        self.seed()
+        for name, plan, problems in check_query_plans():
+            self.assertEqual(problems, [], '%s: %s' % (name, plan))